@@ -0,0 +1,214 @@
+import asyncio, logging, os, shutil, time
+import micro_buildd_conf as conf
+
+def mem_available():
+    with open('/proc/meminfo') as fh:
+        for line in fh:
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+def dir_usage(path):
+    """Disk space used by the files and directories below path"""
+    res = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            try:
+                res += os.lstat(os.path.join(dirpath, name)).st_blocks * 512
+            except OSError:
+                # removed by the build meanwhile
+                pass
+    return res
+
+def process_tree_rss(pids):
+    """Map each of pids to the resident memory of it and all its descendants"""
+    children = {}
+    rss = {}
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f'/proc/{name}/stat', 'rb') as fh:
+                # the command name may contain anything, including ')'
+                fields = fh.read().rsplit(b')', 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        children.setdefault(int(fields[1]), []).append(int(name))
+        rss[int(name)] = int(fields[21]) * page_size
+    res = {}
+    for pid in pids:
+        res[pid] = 0
+        todo = [pid]
+        while todo:
+            p = todo.pop()
+            res[pid] += rss.get(p, 0)
+            todo.extend(children.get(p, ()))
+    return res
+
+class AdmissionController(object):
+    """
+    Decide whether a build may start, based on estimates of its disk space,
+    memory and CPU use from earlier builds of the same source, what the
+    builds already running are still expected to need, the free space in
+    rebuild_tmp_build_dir, free memory and the current load.  Candidates
+    further down the queue may backfill around one which doesn't fit right
+    now, but only for up to conf.admission_max_wait seconds, after which
+    nothing else is started until the head of the queue fits.
+
+    The disk space and memory running builds use already is taken from the
+    free space and free memory, so only what they are expected to need on
+    top of it counts; run() keeps track of their usage.
+
+    Builds of sources whose disk space use is known from earlier builds
+    get their build directory in conf.rebuild_tmpfs_build_dir if it fits
+    the remaining conf.rebuild_tmpfs_budget and free memory, in which case
+    their space counts against memory rather than disk space.
+    """
+
+    estimates = None
+    running = None
+    usage = None
+    chosen = None
+    blocked_head = None
+
+    def __init__(self):
+        self.estimates = {}
+        # key: (space, memory, cpus, tmpfs)
+        self.running = {}
+        # key: (builddir, pid, space used, memory used)
+        self.usage = {}
+        # (key, tmpfs) as last decided by choose(), for start()
+        self.chosen = None
+        self.blocked_head = None
+
+    async def refresh(self, statesdb):
+        self.estimates = await statesdb.build_estimates()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(conf.admission_sample_interval)
+            builds = dict(self.usage)
+            if builds:
+                measured = await loop.run_in_executor(None, self.measure, builds)
+                for key, (space, memory) in measured.items():
+                    # only if it hasn't finished meanwhile
+                    if key in self.usage:
+                        builddir, pid = self.usage[key][:2]
+                        self.usage[key] = (builddir, pid, space, memory)
+
+    @staticmethod
+    def measure(builds):
+        rss = process_tree_rss([pid for builddir, pid, space, memory in builds.values()])
+        return {key: (dir_usage(builddir), rss[pid]) for key, (builddir, pid, space, memory) in builds.items()}
+
+    def known_space(self, package):
+        return self.estimates.get(package, (None, None, None))[0]
+
+    def estimate(self, package):
+        space, memory, cpus = self.estimates.get(package, (None, None, None))
+        return (space if space is not None else conf.admission_default_space,
+                memory if memory is not None else conf.admission_default_memory,
+                cpus if cpus is not None else conf.admission_default_cpus)
+
+    def growth(self, key):
+        """
+        How much more disk space and memory the running build of key is
+        expected to need than it uses already
+        """
+        space, memory, cpus, tmpfs = self.running[key]
+        used_space, used_memory = self.usage.get(key, (None, None, 0, 0))[2:]
+        return max(space - used_space, 0), max(memory - used_memory, 0)
+
+    def choose(self, candidates):
+        """
+        Given the (package, arch) candidates in queue order, return the
+        first one which can be started right now, or None
+        """
+        if not self.running:
+            key = candidates[0]
+            self.chosen = (key, self.fits_tmpfs(key[0]))
+            return key
+        max_cpus = (os.cpu_count() or 1) * conf.admission_max_load
+        if os.getloadavg()[0] > max_cpus:
+            return None
+
+        free_space = self.free_space()
+        free_memory = self.free_memory()
+        free_cpus = max_cpus - sum(cpus for space, memory, cpus, tmpfs in self.running.values())
+
+        now = time.monotonic()
+        for i, key in enumerate(candidates):
+            space, memory, cpus = self.estimate(key[0])
+            tmpfs = self.fits_tmpfs(key[0], free_memory)
+            fits = tmpfs or (space <= free_space and memory <= free_memory)
+            # a build using more CPUs than there are may still run alone
+            if fits and min(cpus, max_cpus) <= free_cpus:
+                self.chosen = (key, tmpfs)
+                return key
+            if i == 0:
+                if self.blocked_head is None or self.blocked_head[0] != key:
+                    logging.info(f'Not enough resources to start build of {key[0]}:{key[1]} yet')
+                    self.blocked_head = (key, now)
+                elif now - self.blocked_head[1] > conf.admission_max_wait:
+                    return None
+        return None
+
+    def free_space(self):
+        res = shutil.disk_usage(conf.rebuild_tmp_build_dir).free - conf.admission_min_free_space
+        for key, (space, memory, cpus, tmpfs) in self.running.items():
+            if not tmpfs:
+                res -= self.growth(key)[0]
+        return res
+
+    def free_memory(self):
+        # MemAvailable already excludes what running builds use, including
+        # their files on tmpfs
+        res = mem_available() - conf.admission_min_free_memory
+        for key, (space, memory, cpus, tmpfs) in self.running.items():
+            space_growth, memory_growth = self.growth(key)
+            res -= space_growth + memory_growth if tmpfs else memory_growth
+        return res
+
+    def fits_tmpfs(self, package, free_memory=None):
+        """
+        Whether a build of package fits conf.rebuild_tmpfs_build_dir, both
+        its budget and free memory
+        """
+        space = self.known_space(package)
+        if conf.rebuild_tmpfs_build_dir is None or space is None:
+            return False
+        memory = self.estimate(package)[1]
+        budget = conf.rebuild_tmpfs_budget - sum(s for s, m, c, tmpfs in self.running.values() if tmpfs)
+        if free_memory is None:
+            free_memory = self.free_memory()
+        return space <= budget and space + memory <= free_memory
+
+    def start(self, key):
+        if self.chosen is not None and self.chosen[0] == key:
+            tmpfs = self.chosen[1]
+        else:
+            tmpfs = self.fits_tmpfs(key[0])
+        self.chosen = None
+        self.running[key] = (*self.estimate(key[0]), tmpfs)
+        if self.blocked_head is not None and self.blocked_head[0] == key:
+            self.blocked_head = None
+
+    def build_started(self, key, builddir, pid):
+        """
+        The build of key now runs in builddir as process pid, whose disk
+        space and memory use run() is to keep track of
+        """
+        self.usage[key] = (builddir, pid, 0, 0)
+
+    def uses_tmpfs(self, key):
+        """
+        Whether the build of key, which must have been started, is to get its
+        build directory in conf.rebuild_tmpfs_build_dir
+        """
+        return self.running[key][3]
+
+    def finish(self, key):
+        self.running.pop(key, None)
+        self.usage.pop(key, None)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+"""
+Generate a synthetic archive to benchmark microbuildd against: a sid-like
+Sources file, plus the rebuild repository Packages files, laid out below a
+base directory the same way micro_buildd_conf lays them out below
+rebuild_base_dir.
+"""
+
+import argparse, hashlib, random
+from pathlib import Path
+
+# always installable, like the essential set and build-essential of a real
+# sid chroot
+BASE_PACKAGES = ('build-essential', 'debhelper', 'debhelper-compat', 'dh-python', 'libc6-dev', 'pkg-config')
+
+def layout(base):
+    """
+    Return a dict of the paths below base the generated files are written to
+    """
+    return {
+        'sources': base / 'Sources',
+        'repo': base / 'repo',
+        'partial': base / 'repo-partial',
+        'packages': lambda arch: base / f'repo/dists/sid/main/binary-{arch}/Packages',
+        'udeb_packages': lambda arch: base / f'repo/dists/sid/main/debian-installer/binary-{arch}/Packages',
+        'partial_packages': lambda arch: base / f'repo-partial/dists/partial/main/binary-{arch}/Packages',
+    }
+
+def checksum_lines(name, version, rng):
+    lines = []
+    for suffix in ('.dsc', '.orig.tar.xz', '.debian.tar.xz'):
+        digest = hashlib.sha256(f'{name}{version}{suffix}'.encode()).hexdigest()
+        lines.append(f' {digest} {rng.randrange(1000, 10 ** 7)} {name}_{version}{suffix}')
+    return '\n'.join(lines)
+
+def build_depends(i, names, rng, missing_fraction, archs):
+    deps = ['debhelper-compat (= 13)']
+    if rng.random() < 0.3:
+        deps.append('dh-python')
+    # only depend on earlier sources, so the dependency graph is a DAG
+    for j in rng.sample(range(i), min(i, rng.randrange(0, 9))):
+        dep = f'lib{names[j]}-dev'
+        r = rng.random()
+        if r < 0.2:
+            dep += f' (>= 1.{j}~)'
+        elif r < 0.3:
+            dep += f' | lib{names[j]}-compat-dev'
+        elif r < 0.35:
+            dep += f' [{rng.choice(archs)}]'
+        deps.append(dep)
+    if rng.random() < missing_fraction:
+        deps.append(f'libnonexistent{i}-dev')
+    return ', '.join(deps)
+
+def generate(base, sources, archs, built_fraction=0.3, binnmu_fraction=0.05, missing_fraction=0.1, seed=0):
+    rng = random.Random(seed)
+    paths = layout(base)
+    names = [f'src{i:06d}' for i in range(sources)]
+    source_stanzas = []
+    packages = {arch: [f'Package: {name}\nVersion: 1.0\nArchitecture: {arch}\nMulti-Arch: foreign\n' for name in BASE_PACKAGES]
+                for arch in archs}
+
+    for i, name in enumerate(names):
+        version = f'{rng.randrange(1, 5)}:1.{i}-1' if rng.random() < 0.05 else f'1.{i}-1'
+        r = rng.random()
+        architecture = 'all' if r < 0.1 else archs[0] if r < 0.15 else 'any'
+        binaries = [f'lib{name}-dev'] + [f'{name}-bin{k}' for k in range(rng.randrange(0, 3))]
+        stanza = [
+            f'Package: {name}',
+            f'Binary: {", ".join(binaries)}',
+            f'Version: {version}',
+            'Maintainer: Benchmark Maintainers <bench@example.org>',
+            f'Build-Depends: {build_depends(i, names, rng, missing_fraction, archs)}',
+            f'Architecture: {architecture}',
+            'Standards-Version: 4.6.2',
+            'Format: 3.0 (quilt)',
+            'Package-List:\n' + '\n'.join(f' {b} deb libdevel optional arch={architecture}' for b in binaries),
+            'Checksums-Sha256:\n' + checksum_lines(name, version, rng),
+            f'Directory: pool/main/{name[:4]}/{name}',
+            'Priority: optional',
+            'Section: misc',
+        ]
+        if rng.random() < 0.2:
+            stanza.insert(5, f'Build-Depends-Indep: python3-sphinx, lib{names[rng.randrange(i)] if i else name}-doc')
+        source_stanzas.append('\n'.join(stanza) + '\n')
+
+        if rng.random() >= built_fraction:
+            continue
+        upstream_version = version.split(':')[-1]
+        for arch in archs if architecture != archs[0] else archs[:1]:
+            binarch = 'all' if architecture == 'all' else arch
+            binversion = upstream_version
+            source_field = name
+            r = rng.random()
+            if r < binnmu_fraction and architecture != 'all':
+                binversion = f'{upstream_version}+b{rng.randrange(1, 4)}'
+                source_field = f'{name} ({upstream_version})'
+            elif r < binnmu_fraction + 0.02:
+                # binaries with their own version, e.g. gcc-defaults
+                binversion = f'2.0+{upstream_version}'
+                source_field = f'{name} ({upstream_version})'
+            for binary in binaries:
+                packages[arch].append('\n'.join([
+                    f'Package: {binary}',
+                    f'Source: {source_field}',
+                    f'Version: {binversion}',
+                    f'Architecture: {binarch}',
+                    f'Depends: libc6-dev{", " + binaries[0] if binary != binaries[0] else ""}',
+                    *((f'Provides: {binary.replace("-dev", "-compat-dev")}',) if binary.endswith('-dev') and rng.random() < 0.1 else ()),
+                    'Multi-Arch: same' if binary.endswith('-dev') else 'Multi-Arch: foreign',
+                    f'Filename: pool/main/{name[:4]}/{name}/{binary}_{binversion}_{binarch}.deb',
+                    f'Size: {rng.randrange(1000, 10 ** 6)}',
+                    'Description: synthetic benchmark package',
+                ]) + '\n')
+
+    paths['sources'].parent.mkdir(parents=True, exist_ok=True)
+    paths['sources'].write_text('\n'.join(source_stanzas))
+    for arch in archs:
+        for key in ('packages', 'udeb_packages', 'partial_packages'):
+            paths[key](arch).parent.mkdir(parents=True, exist_ok=True)
+        paths['packages'](arch).write_text('\n'.join(packages[arch]))
+        paths['udeb_packages'](arch).write_text('')
+        paths['partial_packages'](arch).write_text('')
+    (paths['repo'] / 'incoming').mkdir(parents=True, exist_ok=True)
+    return paths
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic archive for benchmarking microbuildd')
+    parser.add_argument('base', type=Path, help='directory to generate the archive in')
+    parser.add_argument('--sources', type=int, default=5000, help='number of source packages')
+    parser.add_argument('--archs', default='amd64,i386', help='comma separated architectures')
+    parser.add_argument('--built-fraction', type=float, default=0.3, help='fraction of sources already built in the rebuild repository')
+    parser.add_argument('--binnmu-fraction', type=float, default=0.05, help='fraction of built sources with binNMUs')
+    parser.add_argument('--missing-fraction', type=float, default=0.1, help='fraction of sources with unsatisfiable build dependencies')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    generate(args.base, args.sources, args.archs.split(','), args.built_fraction, args.binnmu_fraction, args.missing_fraction, args.seed)
+
+if __name__ == '__main__':
+    main()
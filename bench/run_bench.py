@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark microbuildd against a synthetic archive (see gen_archive.py),
+with the external tools replaced by the stand-ins in stubs/.  Runs
+entirely offline in a temporary directory and prints the results as JSON.
+"""
+
+import argparse, asyncio, importlib.machinery, json, os, platform, subprocess, sys, tempfile, time
+from contextlib import contextmanager
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+TOP_DIR = BENCH_DIR.parent
+sys.path.insert(0, str(TOP_DIR))
+
+import gen_archive
+import micro_buildd_conf as conf
+
+def configure(base, paths, args):
+    """
+    Point micro_buildd_conf at the generated archive.  This must happen
+    before the microbuildd modules are imported.
+    """
+    conf.rebuild_base_dir = base
+    conf.rebuild_archs = args.archs.split(',')
+    conf.rebuild_indep_build_arch = conf.rebuild_archs[0]
+    conf.build_workers = args.workers
+    conf.dose_jobs = len(conf.rebuild_archs) + 1
+    conf.incoming_interval = args.incoming_interval
+    conf.apt_sources_path = paths['sources']
+    conf.rebuild_logs_dir = base / 'logs'
+    conf.rebuild_tmp_build_dir = base / 'build'
+    conf.rebuild_repo_base_dir = paths['repo']
+    conf.rebuild_repo_incoming_dir = paths['repo'] / 'incoming'
+    conf.rebuild_repo_partial_base_dir = paths['partial']
+    conf.database_path = base / 'microbuildd.sqlite'
+    conf.index_database_path = base / 'index.sqlite'
+    conf.scan_snapshot_path = base / 'scan-snapshot.pickle'
+    conf.deb_cache_dir = None
+    conf.metrics_listen = None
+    conf.metrics_trace_dir = None
+    # the stand-in sbuild doesn't produce any load worth backing off from
+    conf.admission_max_load = float('inf')
+    for path in (conf.rebuild_logs_dir, conf.rebuild_tmp_build_dir):
+        path.mkdir(parents=True, exist_ok=True)
+
+    os.environ['PATH'] = f'{BENCH_DIR / "stubs"}{os.pathsep}{os.environ["PATH"]}'
+    os.environ['BENCH_DOSE_US_PER_SOURCE'] = str(args.dose_us_per_source)
+    os.environ['BENCH_SBUILD_SECONDS'] = str(args.sbuild_seconds)
+    os.environ['BENCH_SBUILD_LOG_KB'] = str(args.sbuild_log_kb)
+    os.environ['BENCH_SBUILD_FAIL_RATE'] = str(args.sbuild_fail_rate)
+    os.environ['BENCH_REPREPRO_SECONDS'] = str(args.reprepro_seconds)
+
+@contextmanager
+def timed(results, name):
+    start = time.perf_counter()
+    yield
+    results[name] = time.perf_counter() - start
+
+async def state_counts(statesdb):
+    async with statesdb.db.execute("""SELECT State, count(*) AS Count FROM states GROUP BY State""") as cursor:
+        return {row['State']: row['Count'] async for row in cursor}
+
+async def bench_scan_and_update(results, args):
+    import repo, states
+    r = repo.Repo(asyncio.Lock())
+    statesdb = states.States()
+    await statesdb.__aenter__()
+    try:
+        with timed(results, 'scan_full_seconds'):
+            await r.scan()
+        r.last_full_scan = None
+
+        with timed(results, 'update_initial_seconds'):
+            await statesdb.update(r)
+        with timed(results, 'update_noop_seconds'):
+            await statesdb.update(r)
+        results['states'] = await state_counts(statesdb)
+
+        leases = min(args.leases, results['states'].get('Needs-Build', 0))
+        waits = []
+        for _ in range(leases):
+            start = time.perf_counter()
+            async with statesdb.get_package_to_build(first_time=True, event_to_signal_on_failure=asyncio.Event()) as lease:
+                waits.append(time.perf_counter() - start)
+                await lease.set_build_result('Given-Back')
+        results['lease_count'] = leases
+        if waits:
+            waits.sort()
+            results['lease_mean_seconds'] = sum(waits) / len(waits)
+            results['lease_p95_seconds'] = waits[int(len(waits) * 0.95)]
+    finally:
+        await statesdb.__aexit__()
+
+async def bench_builds(results, args):
+    loader = importlib.machinery.SourceFileLoader('micro_buildd', str(TOP_DIR / 'micro_buildd'))
+    micro_buildd = loader.load_module()
+    async with micro_buildd.MicroBuilddController() as controller:
+        # undo the lease benchmark giving back everything it leased
+        await controller.statesdb.db.execute("""UPDATE states SET State = "Needs-Build" WHERE State == "Given-Back" """)
+        await controller.statesdb.db.commit()
+        async with controller.statesdb.db.execute("""SELECT count(*) FROM logs""") as cursor:
+            logs_before = (await cursor.fetchone())[0]
+
+        start = time.perf_counter()
+        tasks = [asyncio.create_task(controller.incoming_loop())]
+        tasks += [asyncio.create_task(controller.build_worker(worker_id)) for worker_id in range(conf.build_workers)]
+        await asyncio.sleep(args.build_duration)
+        elapsed = time.perf_counter() - start
+        # running builds are shielded from cancellation, wait for them to
+        # finish before the database is closed
+        for task in tasks:
+            task.cancel()
+        await asyncio.wait(tasks)
+
+        async with controller.statesdb.db.execute("""SELECT Status, count(*) AS Count FROM logs
+            WHERE RowId > :Before GROUP BY Status""", {'Before': logs_before}) as cursor:
+            statuses = {row['Status']: row['Count'] async for row in cursor}
+        results['build_seconds'] = elapsed
+        results['build_statuses'] = statuses
+        results['builds_per_hour'] = sum(statuses.values()) / elapsed * 3600
+        results['states_after_builds'] = await state_counts(controller.statesdb)
+
+def metrics_summaries():
+    import metrics
+    res = {}
+    with metrics.registry.lock:
+        items = list(metrics.registry.values.items())
+    for (name, labels), value in sorted(items):
+        key = name + ''.join(f',{k}={v}' for k, v in labels)
+        res[key] = {'count': value[0], 'sum': value[1]} if isinstance(value, list) else value
+    return res
+
+def git_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=TOP_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark microbuildd against a synthetic archive')
+    parser.add_argument('--sources', type=int, default=5000, help='number of source packages to generate')
+    parser.add_argument('--archs', default='amd64,i386', help='comma separated architectures')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--leases', type=int, default=200, help='number of leases to time')
+    parser.add_argument('--workers', type=int, default=4, help='build workers for the build benchmark')
+    parser.add_argument('--build-duration', type=float, default=60, help='seconds to run builds for, 0 to skip')
+    parser.add_argument('--incoming-interval', type=float, default=15, help='seconds between incoming processing runs')
+    parser.add_argument('--dose-us-per-source', type=float, default=200)
+    parser.add_argument('--sbuild-seconds', type=float, default=2)
+    parser.add_argument('--sbuild-log-kb', type=float, default=500)
+    parser.add_argument('--sbuild-fail-rate', type=float, default=0.05)
+    parser.add_argument('--reprepro-seconds', type=float, default=0.5)
+    parser.add_argument('--keep', action='store_true', help='keep the temporary directory')
+    parser.add_argument('--output', type=Path, help='write results to this file instead of stdout')
+    args = parser.parse_args()
+
+    base = Path(tempfile.mkdtemp(prefix='microbuildd-bench-'))
+    results = {}
+    with timed(results, 'generate_seconds'):
+        paths = gen_archive.generate(base, args.sources, args.archs.split(','), seed=args.seed)
+    configure(base, paths, args)
+
+    asyncio.run(bench_scan_and_update(results, args))
+    if args.build_duration > 0:
+        asyncio.run(bench_builds(results, args))
+
+    report = {
+        'version': git_version(),
+        'python': platform.python_version(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'params': {k: str(v) if isinstance(v, Path) else v for k, v in vars(args).items()},
+        'results': results,
+        'metrics': metrics_summaries(),
+    }
+    if args.keep:
+        report['directory'] = str(base)
+    else:
+        subprocess.run(['rm', '-rf', str(base)])
+    out = json.dumps(report, indent=2) + '\n'
+    if args.output is not None:
+        args.output.write_text(out)
+    else:
+        sys.stdout.write(out)
+
+if __name__ == '__main__':
+    main()
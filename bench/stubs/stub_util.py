@@ -0,0 +1,39 @@
+"""
+Helpers shared by the stand-ins for the external tools microbuildd runs.
+Their delays and output sizes are set through BENCH_* environment
+variables, see run_bench.py.
+"""
+
+import os, re
+
+def env_float(name, default):
+    return float(os.environ.get(name, default))
+
+def parse_stanzas(path):
+    """
+    Parse a Sources or Packages style file into a list of dicts, keeping
+    only the first line of multi-line fields
+    """
+    res = []
+    with open(path) as fh:
+        for stanza in re.split('\n\n+', fh.read()):
+            fields = {}
+            for line in stanza.split('\n'):
+                if line and not line[0].isspace():
+                    name, _, value = line.partition(':')
+                    fields[name] = value.strip()
+            if fields:
+                res.append(fields)
+    return res
+
+def relation_alternatives(field):
+    """
+    Split a relationship field into a list of lists of alternative package
+    names, ignoring versions, arch and profile restrictions
+    """
+    res = []
+    for rel in field.split(','):
+        names = [m[1] for m in (re.match(r'\s*([^\s(\[<:]+)', alt) for alt in rel.split('|')) if m]
+        if names:
+            res.append(names)
+    return res
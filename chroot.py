@@ -1,26 +1,155 @@
 from pathlib import Path
-import asyncio, logging, os, re, shutil, warnings
+import asyncio, json, logging, os, re, shutil, signal, sys, time, warnings
 from debian import deb822
 from contextlib import contextmanager
+import failures, metrics, rwlock
 import micro_buildd_conf as conf
 
+LOG_CHUNK_SIZE = 1024 * 1024
+# how far back read_log_tail() looks for sbuild's summary before giving up,
+# which leaves plenty for the failure excerpt of a build killed before
+# sbuild wrote one
+LOG_TAIL_LINES = 2000
+LOG_TAIL_BYTES = 16 * LOG_CHUNK_SIZE
+RUSAGE_WRAPPER = Path(__file__).resolve().parent / 'rusage_wrapper.py'
+
 class Chroot(object):
+    incoming_lock = None
+    deb_cache = None
+    chroot_locks = None
+    update_locks = None
+    generation_users = None
+    retired_generations = None
+
+    def __init__(self, incoming_lock, deb_cache=None):
+        self.incoming_lock = incoming_lock
+        self.deb_cache = deb_cache
+        # for chroots updated in place, builds hold their chroot's lock
+        # shared and sbuild-update holds it exclusive, so updating one
+        # arch's chroot doesn't block builds using another
+        self.chroot_locks = {arch: rwlock.RWLock() for arch in conf.rebuild_archs}
+        self.update_locks = {arch: asyncio.Lock() for arch in conf.rebuild_archs}
+        # for snapshotted chroots (see conf.sbuild_chroot_path), the number of
+        # running builds per generation directory, and the generations which
+        # have been swapped out and are to be removed once no build uses them
+        self.generation_users = {arch: {} for arch in conf.rebuild_archs}
+        self.retired_generations = {arch: set() for arch in conf.rebuild_archs}
+
     async def update(self):
+        await asyncio.gather(*(self.update_arch(arch) for arch in conf.rebuild_archs))
+
+    async def update_arch(self, arch):
+        async with self.update_locks[arch]:
+            with metrics.registry.timer('microbuildd_chroot_update_seconds', arch=arch):
+                await self._update_arch(arch)
+
+    async def _update_arch(self, arch):
+        link = conf.sbuild_chroot_path(arch)
+        if link is None:
+            async with self.chroot_locks[arch].exclusive():
+                await self.run_sbuild_update(arch, conf.sbuild_chroot_name(arch))
+        elif not link.is_symlink():
+            logging.warning(f'{link} is not a symlink, updating build chroot for {arch} in place')
+            async with self.chroot_locks[arch].exclusive():
+                await self.run_sbuild_update(arch, conf.sbuild_chroot_name(arch))
+        else:
+            await self.update_snapshot(arch, link)
+
+    async def run_sbuild_update(self, arch, chroot_name):
+        logging.info(f'Updating build chroot {chroot_name}')
+        with open(conf.rebuild_chroot_update_log_path(arch), 'w') as outfile:
+            proc = await asyncio.create_subprocess_exec(
+                'sbuild-update', f'--chroot-mode={conf.sbuild_chroot_mode}', '--update', '--dist-upgrade', '--autoremove', chroot_name,
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=outfile,
+                stderr=asyncio.subprocess.STDOUT)
+            await proc.wait()
+        if proc.returncode != 0:
+            logging.warning(f'sbuild-update process failed, see {str(conf.rebuild_chroot_update_log_path(arch))}')
+        return proc.returncode == 0
+
+    async def update_snapshot(self, arch, link):
+        """
+        Copy the current generation of the chroot behind the symlink link,
+        update the copy via the staging chroot and, if that worked, atomically
+        point link at it.  Builds already running keep using the generation
+        they started with, which is removed after the last of them finishes.
+        """
+        current = link.parent / os.readlink(link)
+        newgen = link.with_name(f'{link.name}.gen-{time.strftime("%Y%m%d%H%M%S")}')
+        staging = link.with_name(f'{link.name}-staging')
+        proc = await asyncio.create_subprocess_exec(
+            'cp', '-a', '--reflink=auto', str(current), str(newgen),
+            stdin=asyncio.subprocess.DEVNULL)
+        await proc.wait()
+        if proc.returncode != 0:
+            logging.warning(f'Failed to copy build chroot {current} to {newgen}')
+            await self.remove_generation(newgen)
+            return
+        self.replace_symlink(staging, newgen.name)
+        ok = await self.run_sbuild_update(arch, conf.sbuild_staging_chroot_name(arch))
+        staging.unlink()
+        if not ok:
+            await self.remove_generation(newgen)
+            return
+        self.replace_symlink(link, newgen.name)
+        logging.info(f'Switched build chroot for {arch} to {newgen}')
+        await self.remove_retired_generations(arch, link)
+
+    async def remove_retired_generations(self, arch, link):
+        """
+        Remove the generations of the chroot behind the symlink link other
+        than the current one which no build uses any more, including those
+        left behind by an earlier run; the others are removed when their
+        last build finishes
+        """
+        current = link.parent / os.readlink(link)
+        for gen in link.parent.glob(f'{link.name}.gen-*'):
+            if gen != current and not gen.is_symlink():
+                self.retired_generations[arch].add(gen)
+        for gen in list(self.retired_generations[arch]):
+            if not self.generation_users[arch].get(gen):
+                await self.remove_generation(gen)
+
+    async def remove_stale_generations(self):
         for arch in conf.rebuild_archs:
-            logging.info(f'Updating build chroot for {arch}')
-            with open(conf.rebuild_chroot_update_log_path(arch), 'w') as outfile:
-                proc = await asyncio.create_subprocess_exec(
-                    'sbuild-update', f'--chroot-mode={conf.sbuild_chroot_mode}', '--update', '--dist-upgrade', '--autoremove', conf.sbuild_chroot_name(arch),
-                    stdin=asyncio.subprocess.DEVNULL,
-                    stdout=outfile,
-                    stderr=asyncio.subprocess.STDOUT)
-                await proc.wait()
-            if proc.returncode != 0:
-                logging.warning(f'sbuild-update process failed, see {str(conf.rebuild_chroot_update_log_path(arch))}')
+            link = conf.sbuild_chroot_path(arch)
+            if link is not None and link.is_symlink():
+                await self.remove_retired_generations(arch, link)
+
+    def replace_symlink(self, link, target):
+        tmplink = link.with_name(link.name + '.tmp')
+        tmplink.unlink(missing_ok=True)
+        tmplink.symlink_to(target)
+        tmplink.rename(link)
+
+    async def remove_generation(self, path):
+        for arch in conf.rebuild_archs:
+            self.retired_generations[arch].discard(path)
+        logging.info(f'Removing old build chroot {path}')
+        proc = await asyncio.create_subprocess_exec(
+            'rm', '-rf', '--one-file-system', str(path),
+            stdin=asyncio.subprocess.DEVNULL)
+        await proc.wait()
+        if proc.returncode != 0:
+            logging.warning(f'Failed to remove old build chroot {path}')
+
+    def remove_stale_builddirs(self):
+        for base in (conf.rebuild_tmp_build_dir, conf.rebuild_tmpfs_build_dir):
+            if base is None or not base.is_dir():
+                continue
+            for path in base.iterdir():
+                if path.is_dir() and not path.is_symlink():
+                    logging.info(f'Removing stale build directory {path}')
+                    shutil.rmtree(path)
 
     @contextmanager
-    def mkbuilddir(self, package, architecture, version):
-        path = conf.rebuild_tmp_build_dir / f'{package}:{architecture}_{version}'
+    def mkbuilddir(self, package, architecture, version, tmpfs=False):
+        if tmpfs:
+            # tmpfs comes up empty after a reboot
+            conf.rebuild_tmpfs_build_dir.mkdir(parents=True, exist_ok=True)
+        base = conf.rebuild_tmpfs_build_dir if tmpfs else conf.rebuild_tmp_build_dir
+        path = base / f'{package}:{architecture}_{version}'
         os.mkdir(path)
         try:
             yield path
@@ -28,69 +157,273 @@ class Chroot(object):
             shutil.rmtree(path)
 
     async def build(self, build_lease, statesdb):
+        metrics.registry.inc('microbuildd_builds_running')
+        try:
+            with metrics.registry.timer('microbuildd_build_seconds', arch=build_lease.architecture) as labels:
+                try:
+                    await self._build_in_chroot(build_lease, statesdb)
+                finally:
+                    # the lease records Internal-Error for builds which didn't get to a result
+                    labels['result'] = build_lease.build_result or 'Internal-Error'
+        finally:
+            metrics.registry.inc('microbuildd_builds_running', -1)
+
+    async def _build_in_chroot(self, build_lease, statesdb):
+        buildArch = conf.rebuild_indep_build_arch if build_lease.architecture == 'all' else build_lease.architecture
+        link = conf.sbuild_chroot_path(buildArch)
+        if link is None or not link.is_symlink():
+            async with self.chroot_locks[buildArch].shared():
+                await self._build(build_lease, statesdb)
+            return
+
+        # sbuild resolves the symlink itself right after this, and a swap in
+        # between just means the generation recorded here is kept around
+        # unnecessarily long
+        gen = link.parent / os.readlink(link)
+        users = self.generation_users[buildArch]
+        users[gen] = users.get(gen, 0) + 1
+        try:
+            await self._build(build_lease, statesdb)
+        finally:
+            users[gen] -= 1
+            if not users[gen]:
+                del users[gen]
+                if gen in self.retired_generations[buildArch]:
+                    await self.remove_generation(gen)
+
+    async def _build(self, build_lease, statesdb):
         package = build_lease.package
         architecture = build_lease.architecture
         version = build_lease.version
-        binnmu_version = build_lease.binnmu_version
-        binnmu_changelog = build_lease.binnmu_changelog
-        with self.mkbuilddir(package, architecture, version) as builddir:
-            logging.info(f'Starting build of {package}:{architecture} version {build_lease.versionstr()}')
-            buildArch = conf.rebuild_indep_build_arch if architecture == 'all' else architecture
-            proc = await asyncio.create_subprocess_exec(
-                'sbuild', f'--arch={buildArch}',
-                f'--chroot-mode={conf.sbuild_chroot_mode}',
-                '-c', f'chroot:{conf.sbuild_chroot_name(buildArch)}',
-                '-d', 'unstable',
-                '--no-arch-any' if architecture == 'all' else '--no-arch-all',
-                *((f'--binNMU={binnmu_version}', f'--make-binNMU={binnmu_changelog}') if binnmu_version is not None else ()),
-                '-m', conf.maintainer,
-                '--keyid', conf.sbuild_key_id, f'{package}_{version}',
-                cwd=builddir,
-                stdin=asyncio.subprocess.DEVNULL,
-                stdout=asyncio.subprocess.DEVNULL, # sbuild creates log file itself, no need to save redundant stdout
-                stderr=asyncio.subprocess.DEVNULL)
-            await proc.wait()
+        admission = build_lease.admission
+        tmpfs = admission is not None and admission.uses_tmpfs((package, architecture))
+        with self.mkbuilddir(package, architecture, version, tmpfs) as builddir:
+            logging.info(f'Starting build of {package}:{architecture} version {build_lease.versionstr()}{" on tmpfs" if tmpfs else ""}')
+            cache_token = None
+            cache_args = ()
+            if self.deb_cache is not None:
+                # point apt in the chroot at the shared .deb cache
+                cache_token = self.deb_cache.new_token()
+                proxy_conf = f'Acquire::http::Proxy "{self.deb_cache.proxy_url(cache_token)}";'
+                cache_args = (f"--chroot-setup-commands=echo '{proxy_conf}' > /etc/apt/apt.conf.d/99microbuildd-deb-cache",)
+            started = None
+            if admission is not None:
+                started = lambda pid: admission.build_started((package, architecture), builddir, pid)
+            timed_out = await self.run_sbuild(package, architecture, version, build_lease.binnmu_version, build_lease.binnmu_changelog,
+                                              builddir, cache_args, started)
+            cache_stats = self.deb_cache.pop_stats(cache_token) if cache_token is not None else {}
+            await self.finish_build(build_lease, statesdb, builddir, timed_out, {**cache_stats, 'Tmpfs': tmpfs})
 
-            # it's not technically necessary to hold the locks past this point - but
-            # if we do, that means that if the incoming_loop was waiting for the lock
-            # (which should happen on any build taking more than 5 minutes) then the
-            # next iteration will pick up the new artifacts we will place there
+    async def run_sbuild(self, package, architecture, version, binnmu_version, binnmu_changelog, builddir, extra_args=(), started=None):
+        """
+        Build package in builddir, leaving the build log, the .changes file
+        and the files it lists there, and the resource usage of the build in
+        rusage.json.  started, if given, is called with the pid of the build
+        once it runs.  Returns whether the watchdog had to kill the build.
+        """
+        buildArch = conf.rebuild_indep_build_arch if architecture == 'all' else architecture
+        # run sbuild in its own session, so on timeout the watchdog can
+        # kill everything it started via the process group
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, str(RUSAGE_WRAPPER), str(builddir / 'rusage.json'),
+            'sbuild', f'--arch={buildArch}',
+            f'--chroot-mode={conf.sbuild_chroot_mode}',
+            '-c', f'chroot:{conf.sbuild_chroot_name(buildArch)}',
+            '-d', 'unstable',
+            '--no-arch-any' if architecture == 'all' else '--no-arch-all',
+            *((f'--binNMU={binnmu_version}', f'--make-binNMU={binnmu_changelog}') if binnmu_version is not None else ()),
+            *extra_args,
+            '-m', conf.maintainer,
+            '--keyid', conf.sbuild_key_id, f'{package}_{version}',
+            cwd=builddir,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.DEVNULL, # sbuild creates log file itself, no need to save redundant stdout
+            stderr=asyncio.subprocess.DEVNULL,
+            start_new_session=True)
+        if started is not None:
+            started(proc.pid)
+        try:
+            return await self.wait_build(proc, builddir, f'{package}:{architecture}')
+        except asyncio.CancelledError:
+            # a remote worker giving up on a build it lost the lease for
+            await self.kill_build(proc)
+            raise
+
+    async def finish_build(self, build_lease, statesdb, builddir, timed_out, extra_loginfo=None):
+        """
+        Record the outcome of the build of build_lease in builddir, as left
+        there by run_sbuild(): register its log, with extra_loginfo added,
+        move the upload of a successful build to the incoming directory and
+        set the build result
+        """
+        package = build_lease.package
+        architecture = build_lease.architecture
+        version = build_lease.version
+        try:
+            logfile = next(p for p in builddir.glob('*.build') if not p.is_symlink())
+        except StopIteration:
+            logging.warning('sbuild failed to create log file')
+            if timed_out:
+                await build_lease.set_build_result('Build-Timeout')
+            return
+        loop = asyncio.get_running_loop()
+        try:
+            loginfo = await loop.run_in_executor(None, self.scan_log, logfile)
+        except RuntimeError:
+            if not timed_out:
+                raise
+            # killed before sbuild got to write its summary
+            loginfo = {'Filename': logfile.name, 'Package': package, 'Version': version,
+                       'StartTimestamp': None, 'EndTimestamp': 'now'}
+        if timed_out:
+            # sbuild writes its summary on SIGTERM too, with whatever status
+            # the build had got to
+            loginfo['Status'] = 'timeout'
+        loginfo.update(self.read_rusage(builddir / 'rusage.json'))
+        loginfo.update(extra_loginfo or {})
+
+        logging.info(f'Build of {package}:{architecture} version {build_lease.versionstr()} completed with status {loginfo["Status"]}')
+        loginfo['Filename'] = (await loop.run_in_executor(None, self.archive_log, logfile)).name
+        await statesdb.register_log(loginfo)
+        if loginfo['Status'] == 'successful':
             try:
-                logfile = next(p for p in builddir.glob('*.build') if not p.is_symlink())
+                changesfile = next(builddir.glob('*.changes'))
             except StopIteration:
-                logging.warning('sbuild failed to create log file')
+                logging.warning('sbuild failed to create changes file')
                 return
-            loginfo = self.scan_log(logfile)
-
-            logging.info(f'Build of {package}:{architecture} version {build_lease.versionstr()} completed with status {loginfo["Status"]}')
-            logfile.rename(conf.rebuild_logs_dir / logfile.name)
-            await statesdb.register_log(loginfo)
-            if loginfo['Status'] == 'successful':
-                try:
-                    changesfile = next(builddir.glob('*.changes'))
-                except StopIteration:
-                    logging.warning('sbuild failed to create changes file')
-                    return
-                incomingdir = conf.rebuild_repo_incoming_dir
+            incomingdir = conf.rebuild_repo_incoming_dir
+            # hold the incoming lock so reprepro never sees a .changes
+            # file whose listed files haven't all been moved in yet
+            async with self.incoming_lock:
                 with open(changesfile) as fh:
                     changes = deb822.Changes(fh)
                     for fname in (entry['name'] for entry in changes['files']):
                         (builddir / fname).rename(incomingdir / fname)
                 changesfile.rename(incomingdir / changesfile.name)
-                await build_lease.set_build_result('Uploaded')
-            elif loginfo['Status'] == 'attempted':
-                await build_lease.set_build_result('Attempted')
-            elif loginfo['Status'] == 'given-back':
-                await build_lease.set_build_result('Given-Back')
+            await build_lease.set_build_result('Uploaded')
+        elif loginfo['Status'] == 'attempted':
+            await build_lease.set_build_result('Attempted', loginfo)
+        elif loginfo['Status'] == 'given-back':
+            await build_lease.set_build_result('Given-Back', loginfo)
+        elif loginfo['Status'] == 'timeout':
+            await build_lease.set_build_result('Build-Timeout', loginfo)
+        else:
+            warnings.warn(f'Unrecognized status for build of {package} version {version}: {loginfo["Status"]}')
+            await build_lease.set_build_result('Internal-Error', loginfo)
+
+    async def wait_build(self, proc, builddir, name):
+        """
+        Wait for the build process proc to exit, killing its process group
+        if it runs for longer than conf.build_timeout, or the build log in
+        builddir doesn't grow for conf.build_inactivity_timeout.  Returns
+        whether the build was killed.
+        """
+        loop = asyncio.get_running_loop()
+        started = last_activity = loop.time()
+        last_size = None
+        while True:
+            try:
+                await asyncio.wait_for(proc.wait(), conf.build_watchdog_interval)
+                return False
+            except asyncio.TimeoutError:
+                pass
+            now = loop.time()
+            size = 0
+            for p in builddir.glob('*.build'):
+                try:
+                    if not p.is_symlink():
+                        size += p.stat().st_size
+                except OSError:
+                    pass
+            if size != last_size:
+                last_size = size
+                last_activity = now
+            if now - started > conf.build_timeout:
+                logging.warning(f'Build of {name} exceeded the build timeout, killing it')
+            elif now - last_activity > conf.build_inactivity_timeout:
+                logging.warning(f'Build log of {name} has not grown for {int(now - last_activity)}s, killing the build')
             else:
-                warnings.warn(f'Unrecognized status for build of {package} version {version}: {loginfo["Status"]}')
-                await build_lease.set_build_result('Internal-Error')
+                continue
+            await self.kill_build(proc)
+            return True
 
-    def scan_log(self, logpath):
+    async def kill_build(self, proc):
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            try:
+                os.killpg(proc.pid, sig)
+            except ProcessLookupError:
+                pass
+            try:
+                await asyncio.wait_for(proc.wait(), conf.build_kill_grace)
+                return
+            except asyncio.TimeoutError:
+                pass
+        await proc.wait()
+
+    def read_rusage(self, path):
+        try:
+            with open(path) as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            # the wrapper was killed along with sbuild
+            return {}
+
+    def archive_log(self, logpath):
+        """
+        Move logpath into rebuild_logs_dir, compressing it on the way
+        according to conf.log_compression.  Returns the archived path.
+        """
+        if conf.log_compression is None:
+            return logpath.rename(conf.rebuild_logs_dir / logpath.name)
+
+        opener, suffix = failures.LOG_COMPRESSIONS[conf.log_compression]
+        destpath = conf.rebuild_logs_dir / (logpath.name + suffix)
+        tmppath = conf.rebuild_logs_dir / (logpath.name + suffix + '.tmp')
+        try:
+            with open(logpath, 'rb') as src, opener(tmppath, 'wb') as dest:
+                shutil.copyfileobj(src, dest, LOG_CHUNK_SIZE)
+            tmppath.rename(destpath)
+        except BaseException:
+            tmppath.unlink(missing_ok=True)
+            raise
+        logpath.unlink()
+        return destpath
+
+    def read_log_tail(self, logpath):
+        """
+        Return the lines at the end of logpath, reading backwards from the
+        end in chunks just far enough to cover the summary block sbuild
+        writes at the end of the log, or at most about LOG_TAIL_LINES lines
+        if there is none, and at most about LOG_TAIL_BYTES bytes either way
+        """
         # use binary mode in case something in the build process
         # produced non UTF-8 output
-        loglines = open(logpath, 'rb', buffering=False).readall().splitlines()
-        
+        with open(logpath, 'rb') as fh:
+            end = pos = fh.seek(0, os.SEEK_END)
+            loglines = []
+            # the possibly incomplete first line of the chunks read so far
+            partial = b''
+            idx = None
+            # once the end of the summary is found, keep reading until its
+            # start, however many lines it has
+            while pos > 0 and (idx is not None or len(loglines) < LOG_TAIL_LINES) and end - pos < LOG_TAIL_BYTES:
+                chunk_size = min(pos, LOG_CHUNK_SIZE)
+                pos -= chunk_size
+                fh.seek(pos)
+                lines = (fh.read(chunk_size) + partial).splitlines()
+                partial = lines.pop(0) if pos > 0 and lines else b''
+                loglines[:0] = lines
+                if idx is None:
+                    idx = next((i for i in range(len(lines)-1,-1,-1) if lines[i].startswith(b'Finished at ')), None)
+                else:
+                    idx += len(lines)
+                if idx is not None and any(len(l) == 0 for l in loglines[:max(idx - 1, 0)]):
+                    break
+        return loglines
+
+    def scan_log(self, logpath):
+        loglines = self.read_log_tail(logpath)
+
         # expected tail of sbuild log is:
         # <blank line>
         # Field: Value <repeated>
@@ -126,4 +459,6 @@ class Chroot(object):
                 raise RuntimeError('Invalid log file format')
             res[parts[0].translate({ord(' '): None, ord('-'): None})] = parts[1]
 
+        if res.get('Status') != 'successful':
+            res.update(failures.failure_info(loglines[:idx]))
         return res
@@ -0,0 +1,181 @@
+from collections import OrderedDict
+import asyncio, base64, hashlib, logging, os, secrets, shutil, urllib.error, urllib.request
+import httpd
+import micro_buildd_conf as conf
+
+CHUNK_SIZE = 64 * 1024
+# not forwarded between apt and the upstream server
+HOP_BY_HOP_HEADERS = {'connection', 'keep-alive', 'proxy-authorization', 'proxy-connection', 'te', 'trailer',
+                      'transfer-encoding', 'upgrade', 'host', 'content-length'}
+
+class DebCache(object):
+    """
+    Caching HTTP proxy for apt inside the build chroots.  .deb files never
+    change once published under a given URL, so they are kept in
+    conf.deb_cache_dir, evicting the least recently used ones once the
+    cache grows beyond conf.deb_cache_size; everything else is passed
+    through.  Concurrent requests for the same missing file share a single
+    download.  Each build is handed a token to use as proxy user name, and
+    hits and misses are counted per token.
+    """
+
+    entries = None
+    size = 0
+    downloads = None
+    stats = None
+
+    def __init__(self):
+        # file name -> size, least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        self.downloads = {}
+        self.stats = {}
+        conf.deb_cache_dir.mkdir(parents=True, exist_ok=True)
+        files = []
+        for path in conf.deb_cache_dir.iterdir():
+            if path.name.endswith('.tmp'):
+                path.unlink()
+                continue
+            st = path.stat()
+            files.append((st.st_mtime, path.name, st.st_size))
+        for mtime, name, size in sorted(files):
+            self.entries[name] = size
+            self.size += size
+
+    async def run(self):
+        await httpd.serve(self.handle, conf.deb_cache_listen)
+
+    def new_token(self):
+        token = secrets.token_hex(8)
+        self.stats[token] = {'CacheHits': 0, 'CacheMisses': 0, 'CacheHitBytes': 0, 'CacheMissBytes': 0}
+        return token
+
+    def pop_stats(self, token):
+        return self.stats.pop(token, {})
+
+    def proxy_url(self, token):
+        host, port = conf.deb_cache_listen
+        return f'http://{token}:x@{host}:{port}/'
+
+    def request_token(self, request):
+        auth = request.headers.get('proxy-authorization', '')
+        if auth.lower().startswith('basic '):
+            try:
+                return base64.b64decode(auth[6:]).decode().partition(':')[0]
+            except ValueError:
+                pass
+        return None
+
+    async def handle(self, request, reader, writer):
+        if request.method not in ('GET', 'HEAD') or not request.target.startswith('http://'):
+            httpd.send_response(writer, 501, 'Only plain HTTP GET and HEAD requests are supported\n')
+        elif request.method == 'GET' and request.target.endswith(('.deb', '.udeb')):
+            await self.serve_cached(request, writer)
+        else:
+            await self.pass_through(request, writer)
+
+    async def serve_cached(self, request, writer):
+        name = hashlib.sha256(request.target.encode()).hexdigest() + '.deb'
+        hit = name in self.entries
+        if not hit:
+            try:
+                await self.download(request.target, name)
+            except urllib.error.HTTPError as e:
+                httpd.send_response(writer, e.code, f'{e.reason}\n')
+                return
+            except (OSError, urllib.error.URLError) as e:
+                logging.warning(f'Failed to download {request.target}: {e}')
+                httpd.send_response(writer, 502, f'{e}\n')
+                return
+
+        path = conf.deb_cache_dir / name
+        try:
+            # opening right after the lookup, without awaiting anything in
+            # between, means eviction can't remove it under us; once open,
+            # unlinking doesn't matter any more
+            self.entries.move_to_end(name)
+            fh = open(path, 'rb')
+        except (KeyError, FileNotFoundError):
+            # evicted while it was being downloaded, apt would fail the
+            # build on an error
+            await self.pass_through(request, writer)
+            return
+        with fh:
+            size = os.fstat(fh.fileno()).st_size
+            if hit:
+                # keeps the LRU order across restarts
+                os.utime(fh.fileno())
+            stats = self.stats.get(self.request_token(request))
+            if stats is not None and hit:
+                stats['CacheHits'] += 1
+                stats['CacheHitBytes'] += size
+            elif stats is not None:
+                stats['CacheMisses'] += 1
+                stats['CacheMissBytes'] += size
+            httpd.start_response(writer, 200, (('Content-Type', 'application/vnd.debian.binary-package'),
+                                               ('Content-Length', size)))
+            await writer.drain()
+            await asyncio.get_running_loop().sendfile(writer.transport, fh)
+
+    async def download(self, url, name):
+        fut = self.downloads.get(name)
+        if fut is None:
+            fut = asyncio.ensure_future(self._download(url, name))
+            self.downloads[name] = fut
+            fut.add_done_callback(lambda f: self.downloads.pop(name, None))
+        # one client going away must not abort the download for the others
+        await asyncio.shield(fut)
+
+    async def _download(self, url, name):
+        size = await asyncio.get_running_loop().run_in_executor(None, self.fetch, url, name)
+        self.entries[name] = size
+        self.size += size
+        self.evict()
+
+    def fetch(self, url, name):
+        tmppath = conf.deb_cache_dir / (name + '.tmp')
+        try:
+            with urllib.request.urlopen(url, timeout=conf.deb_cache_timeout) as resp, open(tmppath, 'wb') as fh:
+                shutil.copyfileobj(resp, fh, CHUNK_SIZE)
+            size = tmppath.stat().st_size
+            tmppath.rename(conf.deb_cache_dir / name)
+        except BaseException:
+            tmppath.unlink(missing_ok=True)
+            raise
+        return size
+
+    def evict(self):
+        # never evict the most recently added entry
+        while self.size > conf.deb_cache_size and len(self.entries) > 1:
+            name, size = self.entries.popitem(last=False)
+            self.size -= size
+            (conf.deb_cache_dir / name).unlink(missing_ok=True)
+
+    async def pass_through(self, request, writer):
+        loop = asyncio.get_running_loop()
+        headers = {name: value for name, value in request.headers.items() if name not in HOP_BY_HOP_HEADERS}
+        req = urllib.request.Request(request.target, headers=headers, method=request.method)
+        try:
+            resp = await loop.run_in_executor(None, lambda: urllib.request.urlopen(req, timeout=conf.deb_cache_timeout))
+        except urllib.error.HTTPError as e:
+            resp = e
+        except (OSError, urllib.error.URLError) as e:
+            httpd.send_response(writer, 502, f'{e}\n')
+            return
+        with resp:
+            out = [(name, value) for name, value in resp.headers.items() if name.lower() not in HOP_BY_HOP_HEADERS]
+            length = resp.headers.get('Content-Length')
+            if request.method == 'HEAD' or resp.status in (204, 304):
+                httpd.start_response(writer, resp.status, out + ([('Content-Length', length)] if length is not None else []))
+                return
+            chunked = length is None
+            httpd.start_response(writer, resp.status, out + [('Transfer-Encoding', 'chunked') if chunked else ('Content-Length', length)])
+            while True:
+                data = await loop.run_in_executor(None, resp.read, CHUNK_SIZE)
+                if chunked:
+                    httpd.write_chunk(writer, data)
+                elif data:
+                    writer.write(data)
+                if not data:
+                    break
+                await writer.drain()
@@ -0,0 +1,113 @@
+from collections import deque
+import asyncio, gzip, hashlib, io, logging, lzma, re
+import micro_buildd_conf as conf
+
+try:
+    import zstandard
+except ImportError:
+    # only needed for log_compression = 'zstd'
+    zstandard = None
+
+# where the build output ends in an sbuild log, in order of preference:
+# builds which got to running dpkg-buildpackage have the first, the
+# cleanup and summary sections follow in any case
+BUILD_END_RES = [re.compile(rb'^Build finished at '), re.compile(rb'^\| Cleanup +\|$'), re.compile(rb'^\| Summary +\|$')]
+ERROR_RE = re.compile(rb'\berror\b|\b(?-i:\w+Error)\b|undefined reference|internal compiler error|segmentation fault|traceback|^e: |\bfail(ed|ure)?\b',
+                      re.IGNORECASE)
+# error lines which every failed build has, as the failure propagates up
+GENERIC_RE = re.compile(rb'^(make(\[\d+\])?: \*\*\* |dpkg-buildpackage: error: |dh_\w+: error: |E: Build failure)')
+# things which differ between builds failing the same way
+NORMALIZE_RES = [
+    (re.compile(r'/build/[^/\s]+/'), '/build/<dir>/'),
+    (re.compile(r'\b0x[0-9a-f]+\b', re.IGNORECASE), '<hex>'),
+    (re.compile(r'\d+'), '<n>'),
+    (re.compile(r'\s+'), ' '),
+]
+# how much of a line is kept in excerpts
+MAX_LINE_LENGTH = 300
+# how many lines at the end of an archived log to look at, which covers
+# sbuild's cleanup and summary sections with plenty to spare
+ARCHIVED_TAIL_LINES = 2000
+
+def excerpt(loglines):
+    """
+    Return the last conf.failure_excerpt_lines lines of the build output in
+    loglines (the lines at the end of an sbuild log) which look like
+    errors, leaving out the ones every failure ends with, or the last
+    non-empty lines if none do
+    """
+    end = len(loglines)
+    for regex in BUILD_END_RES:
+        idx = next((i for i in range(len(loglines)-1,-1,-1) if regex.match(loglines[i])), None)
+        if idx is not None:
+            end = idx
+            break
+    # leaving out the section banners
+    lines = [l.rstrip() for l in loglines[:end] if l.strip() and not l.startswith(b'+---')]
+    errors = [l for l in lines if ERROR_RE.search(l) and not GENERIC_RE.match(l)]
+    picked = (errors or lines)[-conf.failure_excerpt_lines:]
+    return '\n'.join(l.decode('utf-8', 'replace')[:MAX_LINE_LENGTH] for l in picked)
+
+def signature(text):
+    """
+    Return a hash of text with paths, numbers and whitespace normalized,
+    which is the same for builds failing in the same way
+    """
+    for regex, replacement in NORMALIZE_RES:
+        text = regex.sub(replacement, text)
+    return hashlib.sha1(text.strip().encode()).hexdigest()
+
+def failure_info(loglines):
+    """
+    Return the log fields describing the failure of a build whose log ends
+    with loglines
+    """
+    text = excerpt(loglines)
+    return {'FailureExcerpt': text, 'FailureSignature': signature(text) if text else ''}
+
+def zstd_open(path, mode):
+    if zstandard is None:
+        raise OSError('zstd compressed logs need the zstandard module (python3-zstandard)')
+    fh = zstandard.open(path, mode)
+    # its reader doesn't iterate over lines by itself
+    return io.BufferedReader(fh) if mode == 'rb' else fh
+
+# log_compression: (open function, suffix)
+LOG_COMPRESSIONS = {'xz': (lzma.open, '.xz'), 'gzip': (gzip.open, '.gz'), 'zstd': (zstd_open, '.zst')}
+
+LOG_READ_ERRORS = (OSError, EOFError, lzma.LZMAError) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+def read_archived_tail(path):
+    opener = {suffix: opener for opener, suffix in LOG_COMPRESSIONS.values()}.get(path.suffix, open)
+    with opener(path, 'rb') as fh:
+        return list(deque(fh, ARCHIVED_TAIL_LINES))
+
+def archived_failure_info(path):
+    try:
+        return failure_info([l.rstrip(b'\r\n') for l in read_archived_tail(path)])
+    except LOG_READ_ERRORS as e:
+        logging.warning(f'Failed to read build log {path}: {e}')
+        # don't try again
+        return {'FailureExcerpt': '', 'FailureSignature': ''}
+
+async def index_archive(statesdb):
+    """
+    Extract failure excerpts from the archived logs of failed builds which
+    don't have one yet, i.e. logs from before excerpts were recorded or of
+    builds which were killed before sbuild wrote its summary
+    """
+    loop = asyncio.get_running_loop()
+    after = 0
+    total = 0
+    while True:
+        rows = await statesdb.unindexed_failure_logs(after, conf.failure_index_batch)
+        if not rows:
+            break
+        infos = {}
+        for rowid, filename in rows:
+            infos[rowid] = await loop.run_in_executor(None, archived_failure_info, conf.rebuild_logs_dir / filename)
+        await statesdb.add_failure_info(infos)
+        after = rows[-1][0]
+        total += len(rows)
+    if total:
+        logging.info(f'Indexed the failures of {total} archived build logs')
@@ -0,0 +1,132 @@
+from http import HTTPStatus
+from pathlib import Path
+import asyncio, logging
+
+class BadRequest(Exception):
+    pass
+
+class Request(object):
+    method = None
+    target = None
+    version = None
+    headers = None
+
+    def __init__(self, method, target, version, headers):
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers
+
+    def keep_alive(self):
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+async def read_headers(reader):
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, sep, value = line.decode('latin-1').partition(':')
+        if not sep:
+            raise BadRequest(f'Invalid header line {line!r}')
+        headers[name.strip().lower()] = value.strip()
+    return headers
+
+async def read_request(reader):
+    """
+    Read the request line and headers of the next request on reader.
+    Returns None if the client closed the connection.  Header names are
+    lowercased; any body is left for the handler to read.
+    """
+    line = await reader.readline()
+    if not line:
+        return None
+    parts = line.decode('latin-1').split()
+    if len(parts) != 3:
+        raise BadRequest(f'Invalid request line {line!r}')
+    return Request(*parts, await read_headers(reader))
+
+async def read_body(reader, request):
+    return await reader.readexactly(int(request.headers.get('content-length', 0)))
+
+def start_response(writer, status, headers):
+    writer.write(f'HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n'.encode('latin-1'))
+    for name, value in headers:
+        writer.write(f'{name}: {value}\r\n'.encode('latin-1'))
+    writer.write(b'\r\n')
+
+def send_response(writer, status, body=b'', content_type='text/plain; charset=utf-8'):
+    if isinstance(body, str):
+        body = body.encode()
+    start_response(writer, status, (('Content-Type', content_type), ('Content-Length', len(body))))
+    writer.write(body)
+
+def write_chunk(writer, data):
+    """
+    Write data as one chunk of a Transfer-Encoding: chunked response, an
+    empty data terminates the response
+    """
+    writer.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+
+async def open_connection(address):
+    """
+    Connect to address, a (host, port) tuple or the path of a Unix socket
+    """
+    if isinstance(address, (str, Path)):
+        return await asyncio.open_unix_connection(address)
+    return await asyncio.open_connection(*address)
+
+def start_request(writer, method, target, headers):
+    writer.write(f'{method} {target} HTTP/1.1\r\n'.encode('latin-1'))
+    for name, value in headers:
+        writer.write(f'{name}: {value}\r\n'.encode('latin-1'))
+    writer.write(b'\r\n')
+
+async def read_response(reader):
+    """
+    Read the status line and headers of a response, returning the status
+    code and the headers with lowercased names
+    """
+    line = await reader.readline()
+    parts = line.decode('latin-1').split(None, 2)
+    if len(parts) < 2 or not parts[1].isdigit():
+        raise BadRequest(f'Invalid status line {line!r}')
+    return int(parts[1]), await read_headers(reader)
+
+async def serve(handler, address):
+    """
+    Serve HTTP/1.1 on address, a (host, port) tuple or the path of a Unix
+    socket, until cancelled.  For each request, handler(request, reader,
+    writer) is awaited and must write a complete response.
+    """
+    async def client(reader, writer):
+        try:
+            while True:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                await handler(request, reader, writer)
+                await writer.drain()
+                if not request.keep_alive():
+                    break
+        except BadRequest as e:
+            logging.warning(f'Bad HTTP request: {e}')
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # the server shutting down; as a connection callback this task
+            # has nobody to propagate the cancellation to
+            pass
+        finally:
+            writer.close()
+
+    if isinstance(address, (str, Path)):
+        Path(address).unlink(missing_ok=True)
+        server = await asyncio.start_unix_server(client, address)
+    else:
+        server = await asyncio.start_server(client, *address)
+    async with server:
+        await server.serve_forever()
@@ -0,0 +1,130 @@
+from debian import deb822
+import asyncio, ctypes, ctypes.util, logging, os
+import micro_buildd_conf as conf
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+
+class IncomingWatcher(object):
+    """
+    Watch the incoming directory of the rebuild repository, and signal
+    event_to_signal once a burst of uploads has settled and at least one
+    new .changes file is present together with all the files it lists.
+    Uses inotify where available and falls back to polling otherwise.
+    """
+
+    event_to_signal = None
+    changed = None
+    seen_changes = None
+
+    def __init__(self, event_to_signal):
+        self.event_to_signal = event_to_signal
+        self.changed = asyncio.Event()
+        self.seen_changes = set()
+
+    def inotify_fd(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+        if libc.inotify_add_watch(fd, os.fsencode(conf.rebuild_repo_incoming_dir), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            os.close(fd)
+            return None
+        return fd
+
+    def drain_inotify(self, fd):
+        # we rescan the whole directory anyway, so don't bother decoding
+        # the individual events
+        try:
+            while os.read(fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        self.changed.set()
+
+    def dir_snapshot(self):
+        res = set()
+        with os.scandir(conf.rebuild_repo_incoming_dir) as it:
+            for entry in it:
+                try:
+                    st = entry.stat()
+                except OSError:
+                    # removed by reprepro since it was listed
+                    continue
+                res.add((entry.name, st.st_size, st.st_mtime_ns))
+        return res
+
+    async def poll_loop(self):
+        while True:
+            try:
+                await self.poll_changes()
+            except Exception as e:
+                logging.error(f'Polling the incoming directory failed, restarting: {e}')
+                # whatever happened in the meantime has been missed
+                self.changed.set()
+                await asyncio.sleep(conf.incoming_poll_interval)
+
+    async def poll_changes(self):
+        snapshot = self.dir_snapshot()
+        while True:
+            await asyncio.sleep(conf.incoming_poll_interval)
+            new_snapshot = self.dir_snapshot()
+            if new_snapshot != snapshot:
+                snapshot = new_snapshot
+                self.changed.set()
+
+    def new_complete_changes(self):
+        found = False
+        present = set()
+        for changespath in conf.rebuild_repo_incoming_dir.glob('*.changes'):
+            try:
+                key = (changespath.name, changespath.stat().st_mtime_ns)
+                present.add(key)
+                if key in self.seen_changes:
+                    continue
+                with open(changespath) as fh:
+                    changes = deb822.Changes(fh)
+                if all((conf.rebuild_repo_incoming_dir / entry['name']).stat().st_size == int(entry['size']) for entry in changes['files']):
+                    self.seen_changes.add(key)
+                    found = True
+            except (OSError, KeyError, ValueError):
+                # .changes file or one of its files vanished or is still
+                # being written, we'll be woken again once it's complete
+                continue
+        self.seen_changes &= present
+        return found
+
+    async def run(self):
+        fd = self.inotify_fd()
+        if fd is not None:
+            asyncio.get_running_loop().add_reader(fd, self.drain_inotify, fd)
+            poll_task = None
+        else:
+            logging.info('inotify not available, polling incoming directory instead')
+            poll_task = asyncio.ensure_future(self.poll_loop())
+
+        try:
+            while True:
+                await self.changed.wait()
+                # wait for things to settle so a burst of uploads gets
+                # handled by a single reprepro run, but not indefinitely
+                deadline = asyncio.get_running_loop().time() + conf.incoming_debounce_max
+                while True:
+                    self.changed.clear()
+                    timeout = min(conf.incoming_debounce, deadline - asyncio.get_running_loop().time())
+                    try:
+                        await asyncio.wait_for(self.changed.wait(), timeout=max(timeout, 0))
+                    except asyncio.TimeoutError:
+                        break
+                if self.new_complete_changes():
+                    logging.info('Scheduling immediate processing of incoming due to new uploads')
+                    self.event_to_signal.set()
+        finally:
+            if fd is not None:
+                asyncio.get_running_loop().remove_reader(fd)
+                os.close(fd)
+            if poll_task is not None:
+                poll_task.cancel()
@@ -0,0 +1,147 @@
+from contextlib import contextmanager
+import json, logging, threading, time
+import httpd
+import micro_buildd_conf as conf
+
+# name -> (Prometheus type, help text) of everything recorded below
+METRICS = {
+    'microbuildd_scan_seconds': ('summary', 'Time taken by a complete buildability scan'),
+    'microbuildd_scan_sources_seconds': ('summary', 'Time taken to read the Sources file'),
+    'microbuildd_scan_binaries_seconds': ('summary', 'Time taken to read the Packages files dose uses, per arch'),
+    'microbuildd_scan_installed_seconds': ('summary', 'Time taken to read the rebuild repository Packages files'),
+    'microbuildd_dose_seconds': ('summary', 'Time taken by a dose-builddebcheck run, per arch'),
+    'microbuildd_dose_report_parse_seconds': ('summary', 'Time spent parsing dose-builddebcheck reports, per arch'),
+    'microbuildd_db_update_seconds': ('summary', 'Time taken to update the states database from a scan'),
+    'microbuildd_state_transitions_total': ('counter', 'State transitions applied by scans, per kind of transition'),
+    'microbuildd_db_commits_total': ('counter', 'Transactions committed by the database writer'),
+    'microbuildd_db_writes_total': ('counter', 'Writes (leases, build results, logs) committed by the database writer'),
+    'microbuildd_process_incoming_seconds': ('summary', 'Time taken by reprepro processincoming'),
+    'microbuildd_chroot_update_seconds': ('summary', 'Time taken to update a build chroot, per arch'),
+    'microbuildd_build_seconds': ('summary', 'Time taken by builds, per arch and result'),
+    'microbuildd_lease_wait_seconds': ('summary', 'Time build workers waited for a package to build'),
+    'microbuildd_builds_running': ('gauge', 'Number of builds currently running'),
+    'microbuildd_packages': ('gauge', 'Number of packages per state'),
+}
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Registry(object):
+    """
+    Process wide store of metrics.  Summaries only keep a count and sum,
+    which is what Prometheus needs to compute rates and averages.  Anything
+    observed while a trace is active is also recorded as a span in it.
+    """
+
+    lock = None
+    values = None
+    collectors = None
+    trace = None
+
+    def __init__(self):
+        # values may be recorded from executor threads
+        self.lock = threading.Lock()
+        # (name, sorted label items) -> value, or [count, sum] for summaries
+        self.values = {}
+        self.collectors = []
+        self.trace = None
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[(name, tuple(sorted(labels.items())))] = value
+
+    def clear(self, name):
+        with self.lock:
+            for key in [key for key in self.values if key[0] == name]:
+                del self.values[key]
+
+    def observe(self, name, start, duration, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            summary = self.values.setdefault(key, [0, 0.0])
+            summary[0] += 1
+            summary[1] += duration
+            if self.trace is not None:
+                self.trace.append({'name': name, 'labels': labels, 'start': start, 'duration': duration})
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Observe how long the body takes in the summary name.  Yields the
+        labels dict, so labels only known at the end can still be added.
+        """
+        start = time.time()
+        t0 = time.monotonic()
+        try:
+            yield labels
+        finally:
+            self.observe(name, start, time.monotonic() - t0, **labels)
+
+    def add_collector(self, collector):
+        """
+        Register a coroutine function to be awaited before each scrape, to
+        bring gauges up to date
+        """
+        self.collectors.append(collector)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            items = sorted(self.values.items())
+        last_name = None
+        for (name, labels), value in items:
+            kind, help = METRICS.get(name, ('untyped', ''))
+            if name != last_name:
+                lines.append(f'# HELP {name} {help}')
+                lines.append(f'# TYPE {name} {kind}')
+                last_name = name
+            labelstr = ','.join(f'{k}="{escape_label(v)}"' for k, v in labels)
+            labelstr = f'{{{labelstr}}}' if labelstr else ''
+            if kind == 'summary':
+                lines.append(f'{name}_count{labelstr} {value[0]}')
+                lines.append(f'{name}_sum{labelstr} {value[1]}')
+            else:
+                lines.append(f'{name}{labelstr} {value}')
+        return '\n'.join(lines) + '\n'
+
+    async def handle(self, request, reader, writer):
+        if request.method != 'GET' or request.target.split('?')[0] != '/metrics':
+            httpd.send_response(writer, 404, 'Not found\n')
+            return
+        for collector in self.collectors:
+            try:
+                await collector()
+            except Exception as e:
+                logging.warning(f'Metrics collector failed: {e}')
+        httpd.send_response(writer, 200, self.render(), 'text/plain; version=0.0.4; charset=utf-8')
+
+    async def run(self):
+        await httpd.serve(self.handle, conf.metrics_listen)
+
+    def start_trace(self):
+        with self.lock:
+            self.trace = []
+
+    def finish_trace(self):
+        """
+        Write the spans recorded since start_trace() to a new JSON file in
+        conf.metrics_trace_dir, keeping only the newest
+        conf.metrics_trace_keep files
+        """
+        with self.lock:
+            trace, self.trace = self.trace, None
+        if trace is None or conf.metrics_trace_dir is None:
+            return
+        conf.metrics_trace_dir.mkdir(parents=True, exist_ok=True)
+        path = conf.metrics_trace_dir / f'trace-{time.strftime("%Y%m%dT%H%M%S")}.json'
+        with open(path, 'w') as fh:
+            json.dump(trace, fh, indent=1)
+        for old in sorted(conf.metrics_trace_dir.glob('trace-*.json'))[:-conf.metrics_trace_keep]:
+            old.unlink()
+
+registry = Registry()
@@ -27,6 +27,100 @@ packages
 """
 rebuild_indep_build_arch = rebuild_archs[0]
 
+"""
+build_workers: number of sbuild builds to run concurrently.  Each
+build gets its own build directory, but they all share the machine's
+CPUs, memory and disk space.  0 to only build on remote workers, see
+worker_listen.
+"""
+build_workers = 1
+
+"""
+Watchdog for hung builds, all in seconds:
+- build_timeout: kill a build running for longer than this in total
+- build_inactivity_timeout: kill a build whose log hasn't grown for this
+  long
+- build_watchdog_interval: how often to check the above
+- build_kill_grace: how long to wait after SIGTERM before sending SIGKILL
+  to the build's process group
+Killed builds end up in state Build-Timeout.
+"""
+build_timeout = 24 * 60 * 60
+build_inactivity_timeout = 150 * 60
+build_watchdog_interval = 60
+build_kill_grace = 60
+
+"""
+retry_*: automatic retries of builds which failed for reasons likely to
+go away by themselves, like a full disk, a broken chroot or a mirror
+being out of sync.
+- retry_states: build results which are always retried
+- retry_fail_stages: sbuild Fail-Stages for which Attempted builds are
+  retried too; Attempted builds failing in any other stage, e.g. build,
+  are not
+- retry_max_attempts: how many times at most to build the same version
+- retry_base_delay, retry_max_delay: a failed build is retried after
+  retry_base_delay seconds, doubling with each further failure up to
+  retry_max_delay.  Retries go back to Needs-Build with the next scan
+  after that, at the end of the queue.
+"""
+retry_states = {'Given-Back', 'Internal-Error', 'Build-Timeout'}
+retry_fail_stages = {'create-session', 'fetch-src', 'check-space', 'apt-get-update', 'install-deps'}
+retry_max_attempts = 5
+retry_base_delay = 30 * 60
+retry_max_delay = 24 * 60 * 60
+
+"""
+priority_boost, priority_max_boost: packages waiting to be built are
+normally built oldest first.  A package which BD-Uninstallable packages
+are waiting for gets to move ahead in the queue by priority_boost
+seconds times the log of the number of packages (directly or
+transitively) waiting on it per hour of expected build time, but by at
+most priority_max_boost seconds, so that nothing waits longer than that
+because of newer, higher priority packages.
+"""
+priority_boost = 60 * 60
+priority_max_boost = 24 * 60 * 60
+
+"""
+priority_default_build_time: the expected build time in seconds of
+packages which haven't been built before
+"""
+priority_default_build_time = 15 * 60
+
+"""
+admission_*: settings for deciding whether another build may start
+while others are running, based on how much disk space, memory and CPU
+time earlier builds of the same source needed.
+- admission_default_space, admission_default_memory: estimates in
+  bytes for sources which haven't been built before
+- admission_default_cpus: how many CPUs a build of a source which hasn't
+  been built before is expected to keep busy
+- admission_min_free_space, admission_min_free_memory: headroom in
+  bytes to always leave free in rebuild_tmp_build_dir and in memory
+- admission_max_load: don't start more builds while the 1 minute load
+  average per CPU, or the CPUs the running builds are expected to keep
+  busy per CPU, is above this
+- admission_max_wait: how long in seconds builds further down the queue
+  may be started ahead of one which doesn't fit yet
+- admission_lookahead: how many queued packages to consider at once
+- admission_recheck_interval: how often in seconds to recheck while
+  waiting for resources to free up
+- admission_sample_interval: how often in seconds to measure the disk
+  space and memory running builds use, of which only what they are
+  expected to need on top counts as taken
+"""
+admission_default_space = 2 * 1024 ** 3
+admission_default_memory = 1024 ** 3
+admission_default_cpus = 1
+admission_min_free_space = 5 * 1024 ** 3
+admission_min_free_memory = 1024 ** 3
+admission_max_load = 1.5
+admission_max_wait = 2 * 60 * 60
+admission_lookahead = 50
+admission_recheck_interval = 60
+admission_sample_interval = 30
+
 """
 sbuild_chroot_mode: the chroot backend to pass to sbuild commands
 """
@@ -38,6 +132,27 @@ sbuild_chroot_name: the name of the chroot to use for sbuild commands
 def sbuild_chroot_name(arch):
     return f'rebuild-{arch}-sbuild'
 
+"""
+sbuild_chroot_path: None to update chroots in place, which blocks builds
+for that arch while sbuild-update runs.  Otherwise the path of a symlink
+to the directory of the chroot sbuild_chroot_name(arch).  Updates then copy
+the chroot to a new generation directory next to the symlink (cp -a
+--reflink=auto, so a reflink capable filesystem makes this cheap),
+update the copy through sbuild_staging_chroot_name(arch), whose directory
+must be the symlink <path>-staging, and atomically repoint the symlink.
+Generations named <path>.gen-* are removed once no build uses them any
+more.
+"""
+def sbuild_chroot_path(arch):
+    return None
+
+"""
+sbuild_staging_chroot_name: the name of the chroot used for updating a
+copy of sbuild_chroot_name(arch), see sbuild_chroot_path
+"""
+def sbuild_staging_chroot_name(arch):
+    return f'rebuild-{arch}-sbuild-staging'
+
 """
 incoming_interval: interval in seconds at which to process the
 incoming queue and reevaluate what packages can be built.  Note
@@ -46,6 +161,56 @@ to avoid doing this too frequently.
 """
 incoming_interval = 30 * 60
 
+"""
+incoming_debounce: when new uploads land in the incoming directory,
+wait until it has been quiet for this many seconds before processing
+them, so that a burst of uploads is handled in one go.
+"""
+incoming_debounce = 30
+
+"""
+incoming_debounce_max: upper limit in seconds on how long a steady
+stream of uploads can delay processing of the incoming directory.
+"""
+incoming_debounce_max = 5 * 60
+
+"""
+incoming_poll_interval: interval in seconds at which to check the
+incoming directory for new uploads on systems without inotify.
+"""
+incoming_poll_interval = 60
+
+"""
+incremental_scan: when reevaluating what packages can be built, only
+pass sources through dose-builddebcheck if their source stanza changed
+or their build relations mention a binary package which was added,
+removed or changed (directly or through its dependencies) since the
+last scan.  Everything else keeps its previous result.
+"""
+incremental_scan = True
+
+"""
+full_scan_interval: interval in seconds at which to do a full
+buildability scan even when incremental_scan is enabled, as a
+safety net for any changes the incremental scan misses.
+"""
+full_scan_interval = 24 * 60 * 60
+
+"""
+scan_snapshot_path: file to persist what incremental_scan remembers from
+the last scan in, so the first scan after a restart is incremental too,
+or None to always start with a full scan
+"""
+scan_snapshot_path = rebuild_base_dir / 'scan-snapshot.pickle'
+
+"""
+dose_jobs: maximum number of dose-builddebcheck processes to run at
+once when reevaluating what packages can be built.  There is one
+process per architecture in rebuild_archs plus one for Architecture:
+all packages.
+"""
+dose_jobs = len(rebuild_archs) + 1
+
 """
 chroot_update_interval: interval in seconds at which to update
 the chroot.  (Note that each sbuild run also updates its snapshot
@@ -66,6 +231,87 @@ rebuild_logs_dir: directory in which logs are stored
 """
 rebuild_logs_dir = rebuild_base_dir / 'logs'
 
+"""
+log_compression: how to compress build logs when moving them into
+rebuild_logs_dir: 'xz', 'gzip', 'zstd' (needs the zstandard module,
+python3-zstandard) or None to store them uncompressed
+"""
+log_compression = 'xz'
+
+"""
+failure_excerpt_lines: how many error lines from the end of the build
+output of a failed build to keep as its failure excerpt, which is what
+microbuildd_query searches and groups failures by
+"""
+failure_excerpt_lines = 10
+
+"""
+failure_index_batch: how many archived logs without a failure excerpt,
+e.g. from before excerpts were kept, are read between database writes
+when indexing them in the background on startup
+"""
+failure_index_batch = 50
+
+"""
+Shared cache of the .deb files apt downloads inside the build chroots,
+see deb_cache.py:
+- deb_cache_dir: directory to keep cached files in, e.g.
+  rebuild_base_dir / 'deb-cache', or None to not use a cache
+- deb_cache_size: size in bytes beyond which the least recently used
+  files are evicted
+- deb_cache_listen: (host, port) for the caching HTTP proxy, which must be
+  reachable from inside the chroots.  The default only works if the
+  chroots share the host's network namespace; with sbuild_chroot_mode
+  backends which give them their own, listen on an address of the host
+  they can reach instead, e.g. that of the container bridge.
+- deb_cache_timeout: timeout in seconds for connecting to and reading
+  from the mirrors
+"""
+deb_cache_dir = None
+deb_cache_size = 20 * 1024 ** 3
+deb_cache_listen = ('127.0.0.1', 3142)
+deb_cache_timeout = 60
+
+"""
+metrics_listen: (host, port), e.g. ('127.0.0.1', 9740), or path of a Unix
+socket on which to serve metrics in Prometheus text format at /metrics,
+or None to not serve them
+"""
+metrics_listen = None
+
+"""
+metrics_trace_dir: directory to write a JSON trace of the timed phases of
+each incoming processing and update cycle to, or None to not write traces
+metrics_trace_keep: number of trace files to keep
+"""
+metrics_trace_dir = None
+metrics_trace_keep = 100
+
+"""
+Remote build workers, see workers.py and microbuildd_worker:
+- worker_listen: (host, port) or path of a Unix socket on which to hand
+  out builds to workers, or None to only build locally
+- worker_token: secret workers have to send as a bearer token, or None
+  to not require one, which is only sensible on a Unix socket
+- worker_heartbeat_interval: how often in seconds workers report back
+  while building
+- worker_lease_timeout: return a build to Needs-Build if its worker
+  hasn't been heard from for this many seconds
+- worker_poll_timeout: how long in seconds a worker asking for something
+  to build waits before being told there is nothing
+- worker_upload_dir: directory the files of builds are uploaded to until
+  they are processed, which should be on the same filesystem as
+  rebuild_repo_incoming_dir
+- worker_build_dir: directory microbuildd_worker builds in
+"""
+worker_listen = None
+worker_token = None
+worker_heartbeat_interval = 60
+worker_lease_timeout = 10 * 60
+worker_poll_timeout = 60
+worker_upload_dir = rebuild_base_dir / 'worker-uploads'
+worker_build_dir = rebuild_base_dir / 'worker-build'
+
 """
 rebuild_chroot_update_log_path: filename of the chroot update log
 """
@@ -78,6 +324,19 @@ for the builds
 """
 rebuild_tmp_build_dir = rebuild_base_dir / 'build'
 
+"""
+rebuild_tmpfs_build_dir: directory on a RAM backed filesystem such as
+tmpfs to use instead of rebuild_tmp_build_dir for builds of sources
+whose earlier builds needed little enough disk space, or None to always
+use rebuild_tmp_build_dir.  It is created if it doesn't exist.
+rebuild_tmpfs_budget: how many bytes builds running there may use in
+total, by the disk space their earlier builds needed; this should not be
+more than the size of the filesystem.  Space used there also counts
+against the memory admission_* leaves free.
+"""
+rebuild_tmpfs_build_dir = None
+rebuild_tmpfs_budget = 8 * 1024 ** 3
+
 """
 rebuild_repo_base_dir: base directory of the main rebuild repository
 """
@@ -115,3 +374,39 @@ def rebuild_repo_partial_packages_path(arch):
 database_path: the path to the sqlite database file
 """
 database_path = rebuild_base_dir / 'microbuildd.sqlite'
+
+"""
+database_pragmas: pragmas to set on the daemon's database connection.  In
+WAL mode, readers such as microbuildd_query never block the daemon and
+vice versa.  synchronous = FULL has every commit wait for an fsync, so a
+claimed lease or a recorded build result survives a power failure; as
+writes are committed in batches (see database_commit_delay), that is
+one fsync per batch rather than per write.
+"""
+database_pragmas = {
+    'journal_mode': 'WAL',
+    'synchronous': 'FULL',
+    'mmap_size': 256 * 1024 ** 2,
+    # negative means KiB rather than pages
+    'cache_size': -64 * 1024,
+    'busy_timeout': 5000,
+}
+
+"""
+database_commit_delay: how long in seconds build results and logs may
+wait to be committed together with other writes.  Leasing a package to
+build always commits straight away.
+"""
+database_commit_delay = 0.1
+
+"""
+pid_path: file the daemon writes its process id to, so that tools such
+as make_binnmu can send it SIGUSR1 to have it reevaluate right away
+"""
+pid_path = rebuild_base_dir / 'microbuildd.pid'
+
+"""
+index_database_path: the path to the sqlite database file caching the
+parsed contents of Sources and Packages files
+"""
+index_database_path = rebuild_base_dir / 'index.sqlite'
@@ -1,29 +1,290 @@
-from debian import deb822, debian_support
+from debian import debian_support
 from pathlib import Path
-import asyncio, gzip, logging, os, yaml, re
+import asyncio, gzip, logging, os, pickle, sys, tempfile, time, yaml, re
+import metrics, tagfile_index
 import micro_buildd_conf as conf
 
+# source fields which influence whether dose considers a source buildable
+SRC_DEPENDS_FIELDS = ('Build-Depends', 'Build-Depends-Indep', 'Build-Depends-Arch')
+SRC_RELATION_FIELDS = SRC_DEPENDS_FIELDS + ('Build-Conflicts', 'Build-Conflicts-Indep', 'Build-Conflicts-Arch')
+SRC_SIGNATURE_FIELDS = ('Version', 'Architecture') + SRC_RELATION_FIELDS
+
+# binary fields which influence the installability of a binary package
+BIN_DEPENDS_FIELDS = ('Depends', 'Pre-Depends')
+BIN_CONFLICTS_FIELDS = ('Conflicts', 'Breaks')
+BIN_SIGNATURE_FIELDS = ('Version', 'Architecture', 'Multi-Arch', 'Essential', 'Provides') + BIN_DEPENDS_FIELDS + BIN_CONFLICTS_FIELDS
+
+# fields kept in the persistent indexes of Sources and Packages files
+SOURCES_INDEX_FIELDS = ('Package', 'Extra-Source-Only', 'Binary') + SRC_SIGNATURE_FIELDS
+PACKAGES_INDEX_FIELDS = ('Package', 'Source') + BIN_SIGNATURE_FIELDS
+
+def relation_names(field):
+    """
+    Return the set of package names mentioned in a relationship field such
+    as Build-Depends, ignoring version constraints, arch and profile
+    restrictions, and arch qualifiers
+    """
+    names = set()
+    for rel in re.split('[,|]', field):
+        if m := re.match(r'\s*([^\s(\[<:]+)', rel):
+            names.add(m[1])
+    return names
+
+def latest_sources(paragraphs):
+    """
+    Return a dict mapping each source package in the Sources paragraphs to
+    the paragraph of its latest version, leaving out sources whose latest
+    version is marked as Extra-Source-Only
+    """
+    res = {}
+    for srcentry in paragraphs:
+        oldentry = res.get(srcentry["Package"], None)
+        if oldentry is None or debian_support.Version(oldentry["Version"]) < debian_support.Version(srcentry["Version"]):
+            # shared by every scan entry and key made from it
+            srcentry["Package"] = sys.intern(srcentry["Package"])
+            srcentry["Version"] = sys.intern(srcentry["Version"])
+            res[srcentry["Package"]] = srcentry
+
+    # now exclude entries where the latest package is marked as
+    # Extra-Source-Only: yes
+    eso_srcs = set()
+    for k, v in res.items():
+        if v.get("Extra-Source-Only", "no") == "yes":
+            eso_srcs.add(k)
+    for k in eso_srcs:
+        del res[k]
+
+    return res
+
+def _compose_event_value(loader, event, skip=False):
+    """
+    Build the plain str/list/dict value (as yaml.BaseLoader would) of the
+    node starting with event, or just consume its events if skip is set
+    """
+    if isinstance(event, yaml.ScalarEvent):
+        return None if skip else event.value
+    elif isinstance(event, yaml.SequenceStartEvent):
+        res = []
+        while not loader.check_event(yaml.SequenceEndEvent):
+            item = _compose_event_value(loader, loader.get_event(), skip)
+            if not skip:
+                res.append(item)
+        loader.get_event()
+        return None if skip else res
+    elif isinstance(event, yaml.MappingStartEvent):
+        res = {}
+        while not loader.check_event(yaml.MappingEndEvent):
+            key = _compose_event_value(loader, loader.get_event(), skip)
+            # installation sets of successful packages are by far the
+            # bulk of the --explain output and we have no use for them
+            value = _compose_event_value(loader, loader.get_event(), skip or key == 'installationset')
+            if not skip and key != 'installationset':
+                res[key] = value
+        loader.get_event()
+        return None if skip else res
+    else:
+        raise RuntimeError(f'Unexpected YAML event {event}')
+
+def iter_dose_report(fh):
+    """
+    Incrementally parse dose-builddebcheck output from fh, yielding each
+    entry of its report as soon as it has been read, so that memory use is
+    bounded by the size of one entry rather than the whole report
+    """
+    # note, because dose-builddebcheck does not properly quote its
+    # string values (such as "0xffff" package name), we intentionally use
+    # yaml.CBaseLoader instead of yaml.CSafeLoader
+    # see also: https://bugs.debian.org/cgi-bin/reportbug.cgi?bug=834059
+    loader = yaml.CBaseLoader(fh)
+    try:
+        loader.get_event()
+        if loader.check_event(yaml.StreamEndEvent):
+            return
+        loader.get_event()
+        if not loader.check_event(yaml.MappingStartEvent):
+            raise RuntimeError('Invalid dose-builddebcheck output')
+        loader.get_event()
+        while not loader.check_event(yaml.MappingEndEvent):
+            key = _compose_event_value(loader, loader.get_event())
+            if key == 'report' and loader.check_event(yaml.SequenceStartEvent):
+                loader.get_event()
+                while not loader.check_event(yaml.SequenceEndEvent):
+                    yield _compose_event_value(loader, loader.get_event())
+                loader.get_event()
+            else:
+                _compose_event_value(loader, loader.get_event(), skip=True)
+    finally:
+        loader.dispose()
+
+class ScanEntry(object):
+    """
+    Scan result for one (package, arch).  reasons is None for buildable
+    packages, otherwise 'unevaluated', the YAML recorded by an earlier scan
+    or the reasons as parsed from the dose report, which are only dumped to
+    YAML by reasons_yaml() when they get written to the database.
+    """
+
+    __slots__ = ('version', 'installed', 'buildable', 'reasons', 'binnmu_version')
+
+    def __init__(self, version):
+        self.version = version
+        self.installed = False
+        self.buildable = False
+        self.reasons = 'unevaluated'
+        self.binnmu_version = None
+
+    def set_buildable(self):
+        self.buildable = True
+        self.reasons = None
+
+    def set_unbuildable(self, reasons):
+        self.buildable = False
+        self.reasons = reasons
+
+    def reasons_yaml(self):
+        if self.reasons is None or isinstance(self.reasons, str):
+            return self.reasons
+        return yaml.safe_dump(self.reasons)
+
 class Repo(object):
+    incoming_lock = None
+    dose_semaphore = None
+    # state remembered from the last completed scan, used to work out which
+    # sources need to be passed through dose-builddebcheck again
+    last_src_signatures = None
+    last_src_relations = None
+    last_binaries = None
+    last_full_scan = None
+    # maps binary package names to the source package building them
+    binary_sources = None
+
+    def __init__(self, incoming_lock):
+        self.incoming_lock = incoming_lock
+        self.dose_semaphore = asyncio.Semaphore(conf.dose_jobs)
+        self.sources_index = tagfile_index.TagFileIndex('Sources', SOURCES_INDEX_FIELDS)
+        self.packages_index = tagfile_index.TagFileIndex('Packages', PACKAGES_INDEX_FIELDS)
+        if conf.incremental_scan and conf.scan_snapshot_path is not None:
+            self.load_snapshot()
+
+    def snapshot_key(self):
+        # anything changing what the snapshot means invalidates it
+        return (SRC_SIGNATURE_FIELDS, BIN_SIGNATURE_FIELDS, tuple(conf.rebuild_archs))
+
+    def load_snapshot(self):
+        try:
+            with open(conf.scan_snapshot_path, 'rb') as fh:
+                key, src_signatures, src_relations, binaries, full_scan_time = pickle.load(fh)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logging.warning(f'Ignoring unreadable scan snapshot {conf.scan_snapshot_path}: {e}')
+            return
+        if key != self.snapshot_key():
+            logging.info('Ignoring scan snapshot from a different configuration')
+            return
+        self.last_src_signatures = src_signatures
+        self.last_src_relations = src_relations
+        self.last_binaries = binaries
+        # stored as wall clock time, as monotonic time doesn't survive a reboot
+        self.last_full_scan = time.monotonic() - (time.time() - full_scan_time)
+
+    def save_snapshot(self):
+        """
+        Persist the state remembered from the last scan, so the first scan
+        after a restart can be incremental.  Must only be called once the
+        results of that scan have been committed to the states database,
+        otherwise the next scan could skip sources whose results were lost.
+        """
+        if conf.scan_snapshot_path is None or self.last_full_scan is None:
+            return
+        full_scan_time = time.time() - (time.monotonic() - self.last_full_scan)
+        tmppath = conf.scan_snapshot_path.with_name(conf.scan_snapshot_path.name + '.tmp')
+        with open(tmppath, 'wb') as fh:
+            pickle.dump((self.snapshot_key(), self.last_src_signatures, self.last_src_relations, self.last_binaries, full_scan_time),
+                        fh, pickle.HIGHEST_PROTOCOL)
+        tmppath.rename(conf.scan_snapshot_path)
+
     def scanSrcs(self):
+        return latest_sources(self.sources_index.paragraphs(conf.apt_sources_path))
+
+    def scanBinaries(self, arch):
+        """
+        Scan the Packages files dose-builddebcheck uses as its binary universe
+        for arch, returning a dict mapping binary package name to the fields
+        relevant to installability
+        """
         res = {}
-        with open(conf.apt_sources_path) as fh:
-            for srcentry in deb822.Sources.iter_paragraphs(fh, use_apt_pkg=False):
-                oldentry = res.get(srcentry["Package"], None)
-                if oldentry is None or debian_support.Version(oldentry["Version"]) < debian_support.Version(srcentry["Version"]):
-                    res[srcentry["Package"]] = srcentry
-
-        # now exclude entries where the latest package is marked as
-        # Extra-Source-Only: yes
-        eso_srcs = set()
-        for k, v in res.items():
-            if v.get("Extra-Source-Only", "no") == "yes":
-                eso_srcs.add(k)
-        for k in eso_srcs:
-            del res[k]
+        for packages_path in (conf.rebuild_repo_packages_path(arch), conf.rebuild_repo_partial_packages_path(arch)):
+            for pkgentry in self.packages_index.paragraphs(packages_path):
+                sig = tuple(pkgentry.get(field, '') for field in BIN_SIGNATURE_FIELDS)
+                res.setdefault(pkgentry['Package'], set()).add(sig)
+        return {pkg: frozenset(sigs) for pkg, sigs in res.items()}
+
+    def changedRelationNames(self, old_binaries, new_binaries):
+        """
+        Work out which package names could resolve differently for a
+        build-dependency now compared to the last scan: binaries added,
+        removed or changed, what they provide or conflict with, and then
+        transitively everything depending on any of those
+        """
+        changed = set()
+        for pkg in old_binaries.keys() | new_binaries.keys():
+            old_sigs = old_binaries.get(pkg, frozenset())
+            new_sigs = new_binaries.get(pkg, frozenset())
+            if old_sigs == new_sigs:
+                continue
+            changed.add(pkg)
+            for sig in old_sigs ^ new_sigs:
+                fields = dict(zip(BIN_SIGNATURE_FIELDS, sig))
+                changed |= relation_names(fields['Provides'])
+                for field in BIN_CONFLICTS_FIELDS:
+                    changed |= relation_names(fields[field])
 
+        rdepends = {}
+        rconflicts = {}
+        for pkg, sigs in new_binaries.items():
+            for sig in sigs:
+                fields = dict(zip(BIN_SIGNATURE_FIELDS, sig))
+                provided = {pkg} | relation_names(fields['Provides'])
+                for field in BIN_DEPENDS_FIELDS:
+                    for name in relation_names(fields[field]):
+                        rdepends.setdefault(name, set()).update(provided)
+                for field in BIN_CONFLICTS_FIELDS:
+                    for name in relation_names(fields[field]):
+                        rconflicts.setdefault(name, set()).update(provided)
+
+        for name in list(changed):
+            changed |= rconflicts.get(name, set())
+
+        todo = list(changed)
+        while todo:
+            for name in rdepends.get(todo.pop(), ()):
+                if name not in changed:
+                    changed.add(name)
+                    todo.append(name)
+
+        return changed
+
+    def dirtySources(self, srcs, src_signatures, src_relations, binaries):
+        """
+        Return a dict mapping each native build arch to the set of sources
+        whose buildability might have changed since the last scan, or None
+        if everything needs to be rechecked
+        """
+        if not conf.incremental_scan or self.last_full_scan is None:
+            return None
+        if time.monotonic() - self.last_full_scan > conf.full_scan_interval:
+            return None
+
+        changed_srcs = {pkg for pkg, sig in src_signatures.items() if self.last_src_signatures.get(pkg) != sig}
+
+        res = {}
+        for arch, arch_binaries in binaries.items():
+            changed_names = self.changedRelationNames(self.last_binaries.get(arch, {}), arch_binaries)
+            res[arch] = changed_srcs | {pkg for pkg, names in src_relations.items() if not names.isdisjoint(changed_names)}
         return res
 
-    async def scanArch(self, arch, srcs, res):
+    async def scanArch(self, arch, srcs, res, previous=None, dirty=None):
         if arch == 'all':
             archFilter = ['all']
         elif arch == 'amd64':
@@ -34,111 +295,175 @@ class Repo(object):
             raise RuntimeError(f'unsupported arch {arch}')
 
         debNativeArch = conf.rebuild_indep_build_arch if arch == 'all' else arch
+        checklist = []
         for pkg, entry in srcs.items():
             if any(a in archFilter for a in entry["Architecture"].split()):
-                res[(pkg, arch)] = { 'Installed': False, 'Version': entry['Version'], 'Buildable': False, 'Reasons': 'unevaluated', 'BinNMUVersion': None }
-
-        proc = await asyncio.create_subprocess_exec('dose-builddebcheck',
-                                                    f'--deb-native-arch={debNativeArch}',
-                                                    '--deb-drop-b-d-arch' if arch == 'all' else '--deb-drop-b-d-indep',
-                                                    '--deb-emulate-sbuild',
-                                                    '--successes',
-                                                    str(conf.rebuild_repo_packages_path(debNativeArch)),
-                                                    str(conf.rebuild_repo_partial_packages_path(debNativeArch)),
-                                                    str(conf.apt_sources_path),
-                                                    stdin=asyncio.subprocess.DEVNULL,
-                                                    stdout=asyncio.subprocess.PIPE
-        )
-        stdout, stderr = await proc.communicate()
-        # note, because dose-builddebcheck does not properly quote its
-        # string values (such as "0xffff" package name), we intentionally use
-        # yaml.CBaseLoader instead of yaml.CSafeLoader
-        # see also: https://bugs.debian.org/cgi-bin/reportbug.cgi?bug=834059
-        debbuildcheck_out = await asyncio.get_running_loop().run_in_executor(
-            None, yaml.load, stdout, yaml.CBaseLoader)
-
-        for entry in debbuildcheck_out['report']:
-            if any(a in archFilter for a in entry['architecture'].split(',')):
-                pkg = entry['package']
-                resentry = res.get((pkg, arch), None)
-                if resentry is not None and resentry['Version'] == entry['version']:
-                    resentry['Buildable'] = True
-                    del resentry['Reasons']
-
-        proc = await asyncio.create_subprocess_exec('dose-builddebcheck',
-                                                    f'--deb-native-arch={debNativeArch}',
-                                                    '--deb-drop-b-d-arch' if arch == 'all' else '--deb-drop-b-d-indep',
-                                                    '--deb-emulate-sbuild',
-                                                    '--explain', '--failures',
-                                                    str(conf.rebuild_repo_packages_path(debNativeArch)),
-                                                    str(conf.rebuild_repo_partial_packages_path(debNativeArch)),
-                                                    str(conf.apt_sources_path),
-                                                    stdin=asyncio.subprocess.DEVNULL,
-                                                    stdout=asyncio.subprocess.PIPE
-        )
-        stdout, stderr = await proc.communicate()
-        # note, because dose-builddebcheck does not properly quote its
-        # string values (such as "0xffff" package name), we intentionally use
-        # yaml.CBaseLoader instead of yaml.CSafeLoader
-        # see also: https://bugs.debian.org/cgi-bin/reportbug.cgi?bug=834059
-        debbuildcheck_out = await asyncio.get_running_loop().run_in_executor(
-            None, yaml.load, stdout, yaml.CBaseLoader)
-
-        for entry in debbuildcheck_out['report']:
-            if any(a in archFilter for a in entry['architecture'].split(',')):
-                pkg = entry['package']
-                resentry = res.get((pkg, arch), None)
-                if resentry is not None and resentry['Version'] == entry['version']:
-                    resentry['Buildable'] = False
-                    resentry['Reasons'] = yaml.safe_dump(entry['reasons'])
-
-    async def scan(self):
+                resentry = res[(pkg, arch)] = ScanEntry(entry['Version'])
+                prev = previous.get((pkg, arch)) if dirty is not None and pkg not in dirty else None
+                # only Needs-Build and BD-Uninstallable say whether the source
+                # was buildable, the other states don't record a dose result
+                if (prev is None or prev[0] != entry['Version'] or prev[2] == 'unevaluated'
+                        or prev[1] not in ('Needs-Build', 'BD-Uninstallable')):
+                    checklist.append(entry)
+                elif prev[1] == 'BD-Uninstallable':
+                    resentry.set_unbuildable(prev[2])
+                else:
+                    resentry.set_buildable()
+
+        if dirty is None:
+            await self.runDose(arch, archFilter, debNativeArch, conf.apt_sources_path, res)
+        elif checklist:
+            logging.info(f'Rechecking {len(checklist)} sources for {arch}')
+            with tempfile.NamedTemporaryFile('w', prefix='microbuildd-', suffix='_Sources') as fh:
+                for entry in checklist:
+                    fh.write(''.join(f'{field}: {value}\n' for field, value in entry.items()))
+                    fh.write('\n')
+                fh.flush()
+                await self.runDose(arch, archFilter, debNativeArch, Path(fh.name), res)
+
+    async def runDose(self, arch, archFilter, debNativeArch, sources_path, res):
+        # a single run reporting both successes and explained failures, so
+        # dose only has to parse its input and solve each source once.
+        # Successes have to be reported too, only what dose evaluated is
+        # known to be buildable; the report is parsed as it comes out of
+        # the pipe, one entry at a time
+        async with self.dose_semaphore:
+            with metrics.registry.timer('microbuildd_dose_seconds', arch=arch):
+                rfd, wfd = os.pipe()
+                with open(rfd, 'rb') as fh:
+                    try:
+                        proc = await asyncio.create_subprocess_exec('dose-builddebcheck',
+                                                                    f'--deb-native-arch={debNativeArch}',
+                                                                    '--deb-drop-b-d-arch' if arch == 'all' else '--deb-drop-b-d-indep',
+                                                                    '--deb-emulate-sbuild',
+                                                                    '--successes', '--failures', '--explain',
+                                                                    str(conf.rebuild_repo_packages_path(debNativeArch)),
+                                                                    str(conf.rebuild_repo_partial_packages_path(debNativeArch)),
+                                                                    str(sources_path),
+                                                                    stdin=asyncio.subprocess.DEVNULL,
+                                                                    stdout=wfd
+                        )
+                    finally:
+                        os.close(wfd)
+                    parse = asyncio.get_running_loop().run_in_executor(
+                        None, self.processDoseReport, fh, arch, archFilter, res)
+                    try:
+                        # shielded, the parser thread keeps reading fh anyway
+                        await asyncio.shield(parse)
+                    except BaseException:
+                        # dose would block writing the rest of its report to
+                        # the pipe otherwise, and the pipe must not be closed
+                        # while the parser may still be reading it
+                        if proc.returncode is None:
+                            proc.kill()
+                        await proc.wait()
+                        await asyncio.wait([parse])
+                        if not parse.cancelled():
+                            parse.exception()
+                        raise
+                    await proc.wait()
+                # 1 means some sources aren't buildable, 64 and above that
+                # dose failed, in which case the report can't be trusted
+                if proc.returncode not in (0, 1):
+                    raise RuntimeError(f'dose-builddebcheck failed with exit code {proc.returncode}')
+
+    def processDoseReport(self, fh, arch, archFilter, res):
+        with metrics.registry.timer('microbuildd_dose_report_parse_seconds', arch=arch):
+            for entry in iter_dose_report(fh):
+                if any(a in archFilter for a in entry['architecture'].split(',')):
+                    pkg = entry['package']
+                    resentry = res.get((pkg, arch), None)
+                    if resentry is not None and resentry.version == entry['version']:
+                        if entry['status'] == 'ok':
+                            resentry.set_buildable()
+                        else:
+                            resentry.set_unbuildable(entry['reasons'])
+
+    async def scan(self, previous=None):
+        """
+        previous, if given, maps (package, arch) to the (Version, State,
+        BDUninstallableReasons) currently recorded for it.  Sources whose
+        buildability can't have changed since the last scan keep the result
+        recorded there instead of being passed through dose-builddebcheck
+        again.
+        """
+        with metrics.registry.timer('microbuildd_scan_seconds'):
+            return await self._scan(previous)
+
+    async def _scan(self, previous):
         logging.info('Generating and processing package buildability info')
 
         res = {}
 
-        srcs = self.scanSrcs()
-
+        with metrics.registry.timer('microbuildd_scan_sources_seconds'):
+            srcs = self.scanSrcs()
+        self.binary_sources = {binary.strip(): pkg for pkg, entry in srcs.items() for binary in entry.get('Binary', '').split(',') if binary.strip()}
+        src_signatures = {pkg: tuple(entry.get(field, '') for field in SRC_SIGNATURE_FIELDS) for pkg, entry in srcs.items()}
+        src_relations = {}
+        for pkg, entry in srcs.items():
+            if self.last_src_signatures is not None and self.last_src_signatures.get(pkg) == src_signatures[pkg]:
+                src_relations[pkg] = self.last_src_relations[pkg]
+            else:
+                src_relations[pkg] = frozenset(name for field in SRC_RELATION_FIELDS for name in relation_names(entry.get(field, '')))
+        binaries = {}
         for arch in conf.rebuild_archs:
-            await self.scanArch(arch, srcs, res)
-        await self.scanArch('all', srcs, res)
+            with metrics.registry.timer('microbuildd_scan_binaries_seconds', arch=arch):
+                binaries[arch] = self.scanBinaries(arch)
+
+        dirty = self.dirtySources(srcs, src_signatures, src_relations, binaries) if previous is not None else None
+        if dirty is None:
+            logging.info('Doing full buildability scan')
+
+        await asyncio.gather(
+            *(self.scanArch(arch, srcs, res, previous, None if dirty is None else dirty[arch]) for arch in conf.rebuild_archs),
+            self.scanArch('all', srcs, res, previous, None if dirty is None else dirty[conf.rebuild_indep_build_arch]))
+
+        self.last_src_signatures = src_signatures
+        self.last_src_relations = src_relations
+        self.last_binaries = binaries
+        if dirty is None:
+            self.last_full_scan = time.monotonic()
 
+        with metrics.registry.timer('microbuildd_scan_installed_seconds'):
+            self.markInstalled(res)
+        return res
+
+    def markInstalled(self, res):
         for buildArch in conf.rebuild_archs:
             for packages_path in (conf.rebuild_repo_packages_path(buildArch), conf.rebuild_repo_udeb_packages_path(buildArch)):
-                with open(packages_path) as fh:
-                    for pkgentry in deb822.Packages.iter_paragraphs(fh, use_apt_pkg=False):
-                        arch = pkgentry['Architecture']
-                        vers = pkgentry['Version']
-                        src = pkgentry.get('Source', pkgentry['Package'])
-                        binnmuver = None
-
-                        # remove +b<n> from tail and put <n> into BinNMUVersion
-                        if m := re.match('(.*)\+b([0-9]+)', vers):
-                            vers = m[1]
-                            binnmuver = int(m[2])
-
-                        # handle e.g. Source: gcc-defaults (1.185.1)
-                        # note: in combination of binNMU with modified package
-                        # version, the package gets e.g.
-                        # Source: gcc-defaults (1.185.1)
-                        # Version: 10.3.1+b1
-                        if m := re.match('([^ ]*) [(](.*)[)]', src):
-                            src = m[1]
-                            vers = m[2]
-
-                        resentry = res.get((src, arch), None)
-                        if resentry is not None and resentry['Version'] == vers:
-                            resentry['Installed'] = True
-                            if binnmuver is not None and (resentry['BinNMUVersion'] is None or binnmuver > resentry['BinNMUVersion']):
-                                resentry['BinNMUVersion'] = binnmuver
+                for pkgentry in self.packages_index.paragraphs(packages_path):
+                    arch = pkgentry['Architecture']
+                    vers = pkgentry['Version']
+                    src = pkgentry.get('Source', pkgentry['Package'])
+                    binnmuver = None
 
-        return res
+                    # remove +b<n> from tail and put <n> into BinNMUVersion
+                    if m := re.match('(.*)\+b([0-9]+)', vers):
+                        vers = m[1]
+                        binnmuver = int(m[2])
+
+                    # handle e.g. Source: gcc-defaults (1.185.1)
+                    # note: in combination of binNMU with modified package
+                    # version, the package gets e.g.
+                    # Source: gcc-defaults (1.185.1)
+                    # Version: 10.3.1+b1
+                    if m := re.match('([^ ]*) [(](.*)[)]', src):
+                        src = m[1]
+                        vers = m[2]
+
+                    resentry = res.get((src, arch), None)
+                    if resentry is not None and resentry.version == vers:
+                        resentry.installed = True
+                        if binnmuver is not None and (resentry.binnmu_version is None or binnmuver > resentry.binnmu_version):
+                            resentry.binnmu_version = binnmuver
 
     async def process_incoming(self):
         logging.info('Processing incoming directory')
-        proc = await asyncio.create_subprocess_exec('reprepro', 'processincoming', 'unstable',
-                                                    cwd=conf.rebuild_repo_base_dir,
-                                                    stdin=asyncio.subprocess.DEVNULL)
-        await proc.wait()
+        async with self.incoming_lock:
+            with metrics.registry.timer('microbuildd_process_incoming_seconds'):
+                proc = await asyncio.create_subprocess_exec('reprepro', 'processincoming', 'unstable',
+                                                            cwd=conf.rebuild_repo_base_dir,
+                                                            stdin=asyncio.subprocess.DEVNULL)
+                await proc.wait()
         if proc.returncode != 0:
             logging.warn('reprepro processincoming failed')
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+
+import json, os, signal, subprocess, sys
+
+def main(argv):
+    """
+    Run a command, then write the resource usage of it and all the
+    descendants it waited for to a JSON file, and exit with its exit code.
+    Used by Chroot.build since asyncio reaps its own child processes,
+    leaving no way to get at their rusage.
+    """
+    if len(argv) < 2:
+        print('Usage: rusage_wrapper.py output.json command [args...]')
+        sys.exit(1)
+    outpath = argv[0]
+    # a SIGTERM to the process group is meant for the command; keep waiting
+    # for it to clean up and exit (handlers are reset to default on exec)
+    signal.signal(signal.SIGTERM, lambda signum, frame: None)
+    proc = subprocess.Popen(argv[1:])
+    _, status, rusage = os.wait4(proc.pid, 0)
+    with open(outpath, 'w') as fh:
+        json.dump({'UserTime': rusage.ru_utime,
+                   'SystemTime': rusage.ru_stime,
+                   'MaxRSS': rusage.ru_maxrss * 1024,
+                   'IOReadBytes': rusage.ru_inblock * 512,
+                   'IOWriteBytes': rusage.ru_oublock * 512}, fh)
+    if os.WIFSIGNALED(status):
+        signal.signal(os.WTERMSIG(status), signal.SIG_DFL)
+        os.kill(os.getpid(), os.WTERMSIG(status))
+    sys.exit(os.waitstatus_to_exitcode(status))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,50 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+class RWLock(object):
+    """
+    Reader/writer lock for asyncio tasks.  Any number of tasks may hold the
+    lock shared at once, while exclusive holders get it to themselves.  A
+    waiting exclusive holder blocks new shared holders, so a steady stream
+    of shared holders can't starve it.
+    """
+
+    cond = None
+    shared_holders = 0
+    exclusive_held = False
+    exclusive_waiting = 0
+
+    def __init__(self):
+        self.cond = asyncio.Condition()
+        self.shared_holders = 0
+        self.exclusive_held = False
+        self.exclusive_waiting = 0
+
+    @asynccontextmanager
+    async def shared(self):
+        async with self.cond:
+            await self.cond.wait_for(lambda: not self.exclusive_held and self.exclusive_waiting == 0)
+            self.shared_holders += 1
+        try:
+            yield
+        finally:
+            async with self.cond:
+                self.shared_holders -= 1
+                self.cond.notify_all()
+
+    @asynccontextmanager
+    async def exclusive(self):
+        async with self.cond:
+            self.exclusive_waiting += 1
+            try:
+                await self.cond.wait_for(lambda: not self.exclusive_held and self.shared_holders == 0)
+            finally:
+                self.exclusive_waiting -= 1
+                self.cond.notify_all()
+            self.exclusive_held = True
+        try:
+            yield
+        finally:
+            async with self.cond:
+                self.exclusive_held = False
+                self.cond.notify_all()
@@ -0,0 +1,67 @@
+import math, yaml
+import repo
+import micro_buildd_conf as conf
+
+def missing_names(reasons):
+    """
+    Return the set of binary package names which dose-builddebcheck reports
+    as missing in the BD-Uninstallable reasons of a package, either YAML
+    dumped or as parsed from the dose report
+    """
+    res = set()
+    if isinstance(reasons, str):
+        # see repo.iter_dose_report on why CBaseLoader
+        reasons = yaml.load(reasons, yaml.CBaseLoader)
+    for reason in reasons or []:
+        missing = reason.get('missing') if isinstance(reason, dict) else None
+        if isinstance(missing, dict) and isinstance(missing.get('pkg'), dict):
+            res |= repo.relation_names(missing['pkg'].get('unsat-dependency', ''))
+    return res
+
+def compute_priorities(availpkgs, binary_sources, build_times):
+    """
+    Rank the buildable packages in availpkgs by how many BD-Uninstallable
+    packages are waiting for them, directly or transitively, per hour of
+    expected build time.  Returns a dict mapping (package, arch) to the
+    priority boost in days to subtract from its Timestamp when picking the
+    next package to build.  The boost is capped at
+    conf.priority_max_boost, so anything which has been waiting longer than
+    that still gets built before newer, higher priority packages.
+    """
+    def blocker_key(src, arch):
+        if arch != 'all' and (src, arch) in availpkgs:
+            return (src, arch)
+        elif (src, 'all') in availpkgs:
+            return (src, 'all')
+        elif (src, conf.rebuild_indep_build_arch) in availpkgs:
+            return (src, conf.rebuild_indep_build_arch)
+        return None
+
+    # blocks maps a package to the BD-Uninstallable packages which are
+    # (partly) waiting for it to be built
+    blocks = {}
+    for (pkg, arch), availentry in availpkgs.items():
+        if availentry.installed or availentry.buildable or availentry.reasons == 'unevaluated':
+            continue
+        for name in missing_names(availentry.reasons):
+            src = binary_sources.get(name)
+            key = blocker_key(src, arch) if src is not None else None
+            if key is not None and key != (pkg, arch):
+                blocks.setdefault(key, set()).add((pkg, arch))
+
+    res = {}
+    for key, blocked in blocks.items():
+        availentry = availpkgs[key]
+        if availentry.installed or not availentry.buildable:
+            continue
+        unblocked = set()
+        todo = list(blocked)
+        while todo:
+            item = todo.pop()
+            if item not in unblocked:
+                unblocked.add(item)
+                todo.extend(blocks.get(item, ()))
+        hours = max(build_times.get(key[0], conf.priority_default_build_time), 60) / 3600
+        boost = min(conf.priority_max_boost, conf.priority_boost * math.log1p(len(unblocked) / hours))
+        res[key] = boost / (24 * 60 * 60)
+    return res
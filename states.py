@@ -1,39 +1,150 @@
-import aiosqlite, asyncio, logging
+import aiosqlite, asyncio, json, logging, sqlite3
 from pathlib import Path
+import metrics, rwlock, scheduler
 import micro_buildd_conf as conf
 
+LOG_RESOURCE_FIELDS = ('UserTime', 'SystemTime', 'MaxRSS', 'IOReadBytes', 'IOWriteBytes')
+LOG_CACHE_FIELDS = ('CacheHits', 'CacheMisses', 'CacheHitBytes', 'CacheMissBytes')
+
+def retryable(newstate, loginfo=None):
+    """
+    Whether a build which ended in newstate, with loginfo as parsed from
+    its log if there is one, failed for a reason which might go away by
+    itself, so is worth retrying later
+    """
+    if newstate in conf.retry_states:
+        return True
+    return newstate == 'Attempted' and loginfo is not None and loginfo.get('FailStage') in conf.retry_fail_stages
+
 class States(object):
 
     db = None
+    metrics_db = None
+    db_lock = None
     db_updated_cond = None
+    write_queue = None
+    writer_task = None
+    failure_search = False
 
-    def __init__(self, lock):
-        self.db_updated_cond = asyncio.Condition(lock)
+    def __init__(self):
+        # single-row changes (leases, build results, logs) are independent of
+        # each other and are committed in groups by the writer task, which
+        # holds db_lock shared; the bulk update from update() holds it
+        # exclusive so nobody else can commit half of its batch
+        self.db_lock = rwlock.RWLock()
+        self.db_updated_cond = asyncio.Condition()
+        self.write_queue = asyncio.Queue()
+        self.writer_task = None
+        self.failure_search = False
 
     async def __aenter__(self):
         self.db = await aiosqlite.connect(conf.database_path)
         self.db.row_factory = aiosqlite.Row
+        for pragma, value in conf.database_pragmas.items():
+            await self.db.execute(f'PRAGMA {pragma} = {value}')
 
         await self.ensure_db()
+        # a read-only connection of its own sees the last committed states
+        # without waiting for an update() in progress
+        self.metrics_db = await aiosqlite.connect(f'file:{conf.database_path}?mode=ro', uri=True)
+        self.metrics_db.row_factory = aiosqlite.Row
+        self.writer_task = asyncio.create_task(self.writer())
 
     async def __aexit__(self, *exc):
+        # everything queued so far still gets written
+        self.write_queue.put_nowait(None)
+        await self.writer_task
+        await self.metrics_db.close()
+        self.metrics_db = None
         await self.db.close()
         self.db = None
 
+    async def write(self, fn, urgent=False):
+        """
+        Have the writer task await fn(), a coroutine function executing
+        statements without committing them, and return its result once
+        they have been committed.  Writes arriving within
+        conf.database_commit_delay of each other share a transaction,
+        unless one of them is urgent, which commits straight away.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.write_queue.put_nowait((fn, future, urgent))
+        return await future
+
+    async def writer(self):
+        loop = asyncio.get_running_loop()
+        stop = False
+        while not stop:
+            batch = [await self.write_queue.get()]
+            deadline = loop.time() + conf.database_commit_delay
+            while batch[-1] is not None and not batch[-1][2]:
+                try:
+                    batch.append(await asyncio.wait_for(self.write_queue.get(), deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    break
+            while batch[-1] is not None and not self.write_queue.empty():
+                batch.append(self.write_queue.get_nowait())
+            if batch[-1] is None:
+                stop = True
+                batch.pop()
+            if batch:
+                await self.write_batch(batch)
+
+    async def write_batch(self, batch):
+        results = []
+        async with self.db_lock.shared():
+            try:
+                # sqlite3 doesn't start a transaction for SAVEPOINT by itself,
+                # the outermost one would commit each write on its own
+                await self.db.execute('BEGIN IMMEDIATE')
+                for fn, future, urgent in batch:
+                    # a failing write only undoes its own statements
+                    await self.db.execute('SAVEPOINT "write"')
+                    try:
+                        results.append((future, await fn(), None))
+                    except Exception as e:
+                        await self.db.execute('ROLLBACK TO "write"')
+                        results.append((future, None, e))
+                    await self.db.execute('RELEASE "write"')
+                await self.db.commit()
+            except Exception as e:
+                logging.error(f'Failed to commit {len(batch)} database writes: {e}')
+                await self.db.rollback()
+                results = [(future, None, e) for fn, future, urgent in batch]
+        metrics.registry.inc('microbuildd_db_commits_total')
+        metrics.registry.inc('microbuildd_db_writes_total', len(batch))
+        for future, result, exc in results:
+            # the writer may have given up waiting, e.g. on shutdown
+            if future.done():
+                continue
+            if exc is not None:
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
+
+    async def reclaim_stale_builds(self):
+        """
+        Return packages left in Building by a previous run which didn't shut
+        down cleanly to Needs-Build
+        """
+        async def reclaim():
+            cursor = await self.db.execute("""UPDATE states
+                SET State = "Needs-Build"
+                WHERE State == "Building"
+                """)
+            return cursor.rowcount
+        rowcount = await self.write(reclaim, urgent=True)
+        if rowcount:
+            logging.info(f'Reclaimed {rowcount} stale Building packages')
+
     def state_for_avail(self, avail):
-        if avail['Installed']:
+        if avail.installed:
             return 'Installed'
-        elif avail['Buildable']:
+        elif avail.buildable:
             return 'Needs-Build'
         else:
             return 'BD-Uninstallable'
 
-    def reasons_for_avail(self, avail):
-        if avail['Installed'] or avail['Buildable']:
-            return ''
-        else:
-            return avail['Reasons']
-
     async def ensure_db(self):
         await self.db.execute("""CREATE TABLE IF NOT EXISTS "states"
             ("RowId" INTEGER PRIMARY KEY,
@@ -47,6 +158,81 @@ class States(object):
              "BinNMUChangelog" TEXT,
              UNIQUE("Package", "Architecture"))
         """)
+        # packages are picked for building in order of SchedKey, which is
+        # the Timestamp moved earlier by the package's priority boost
+        await self.ensure_column('states', 'PriorityBoost', 'REAL NOT NULL DEFAULT 0')
+        await self.ensure_column('states', 'SchedKey', 'REAL GENERATED ALWAYS AS (julianday("Timestamp") - "PriorityBoost") VIRTUAL')
+        await self.db.execute("""DROP INDEX IF EXISTS "states_state_timestamp"
+            """)
+        await self.db.execute("""CREATE INDEX IF NOT EXISTS "states_state_schedkey"
+            ON "states" ("State", "SchedKey", "Package", "Architecture")
+            """)
+        # failed builds of the current version, and when to retry the last
+        # one if it is worth retrying, see retryable()
+        await self.ensure_column('states', 'Attempts', 'INTEGER NOT NULL DEFAULT 0')
+        await self.ensure_column('states', 'RetryAfter', 'TEXT')
+        await self.db.execute("""CREATE INDEX IF NOT EXISTS "states_retryafter"
+            ON "states" ("RetryAfter") WHERE "RetryAfter" IS NOT NULL
+            """)
+        await self.db.execute("""CREATE TABLE IF NOT EXISTS "logs"
+            ("RowId" INTEGER PRIMARY KEY,
+             "Filename" TEXT UNIQUE,
+             "Package" TEXT,
+             "Version" TEXT,
+             "Status" TEXT,
+             "PackageTime" INTEGER,
+             "Space" INTEGER,
+             "StartTimestamp" TEXT,
+             "EndTimestamp" TEXT)
+            """)
+        # resource usage of the whole sbuild process tree, see rusage_wrapper.py
+        for column in LOG_RESOURCE_FIELDS:
+            await self.ensure_column('logs', column, 'REAL' if column.endswith('Time') else 'INTEGER')
+        # how builds fared with the shared .deb cache, see deb_cache.py
+        for column in LOG_CACHE_FIELDS:
+            await self.ensure_column('logs', column, 'INTEGER')
+        # whether the build directory was on tmpfs, see conf.rebuild_tmpfs_build_dir
+        await self.ensure_column('logs', 'Tmpfs', 'INTEGER')
+        # the remote worker which did the build, see workers.py
+        await self.ensure_column('logs', 'Worker', 'TEXT')
+        # failed builds with the same FailureSignature failed the same way,
+        # see failures.py; the excerpts it is computed from go into the full
+        # text index log_failures, keyed by the RowId of the log
+        await self.ensure_column('logs', 'FailureSignature', 'TEXT')
+        await self.db.execute("""CREATE INDEX IF NOT EXISTS "logs_failuresignature"
+            ON "logs" ("FailureSignature") WHERE "FailureSignature" IS NOT NULL
+            """)
+        try:
+            await self.db.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS "log_failures" USING fts5("Excerpt")
+                """)
+            self.failure_search = True
+        except sqlite3.OperationalError as e:
+            logging.warning(f'Not indexing build failures for search: {e}')
+
+        # scratch space for update(), private to this connection
+        await self.db.execute("""CREATE TEMP TABLE IF NOT EXISTS "scan"
+            ("Package" TEXT,
+             "Architecture" TEXT,
+             "Version" TEXT,
+             "State" TEXT,
+             "Reasons" TEXT,
+             "Installed" INTEGER,
+             "Buildable" INTEGER,
+             "BinNMUVersion" INTEGER,
+             PRIMARY KEY("Package", "Architecture"))
+            """)
+        await self.db.execute("""CREATE TEMP TABLE IF NOT EXISTS "priorities"
+            ("Package" TEXT,
+             "Architecture" TEXT,
+             "PriorityBoost" REAL,
+             PRIMARY KEY("Package", "Architecture"))
+            """)
+
+    async def ensure_column(self, table, column, decl):
+        async with self.db.execute(f'PRAGMA table_xinfo("{table}")') as cursor:
+            columns = [row['name'] async for row in cursor]
+        if column not in columns:
+            await self.db.execute(f'ALTER TABLE "{table}" ADD COLUMN "{column}" {decl}')
         
     async def update(self, repo):
         """
@@ -62,109 +248,200 @@ class States(object):
         - Needs-Build -> BD-Uninstallable: add BD-Uninstallable-Reasons, update Timestamp
         - BD-Uninstallable -> BD-Uninstallable with changed BD-Uninstallable-Reasons:
             update BD-Uninstallable-Reasons, do not update Timestamp
+        - Failed build -> Needs-Build once its RetryAfter has passed, if it is
+            still buildable: update Timestamp, so it goes to the end of the queue
 
-        Note that transitions into Building, Attempted, Uploaded, Failed, Given-Back are
-        handled elsewhere - other than the obsolete package and new version cases, or
+        Note that transitions into Building, Attempted, Uploaded, Failed, Given-Back,
+        Build-Timeout are handled elsewhere - other than the obsolete package and new version cases, or
         transitioning into Installed, rows in these states should not be updated
         """
 
-        availpkgs = await repo.scan()
+        availpkgs = await repo.scan(await self.previous_results() if conf.incremental_scan else None)
+
+        logging.info('Computing build priorities')
+        priorities = await asyncio.get_running_loop().run_in_executor(
+            None, scheduler.compute_priorities, availpkgs, repo.binary_sources, await self.expected_build_times())
 
         logging.info('Updating sqlite database from repository status')
 
-        await self.ensure_db()
+        async with self.db_lock.exclusive():
+            with metrics.registry.timer('microbuildd_db_update_seconds'):
+                try:
+                    await self._update_db(availpkgs, priorities)
+                except BaseException:
+                    # the writer starts a transaction of its own for each batch
+                    await self.db.rollback()
+                    raise
+
+        async with self.db_updated_cond:
+            self.db_updated_cond.notify_all()
+
+    async def previous_results(self):
+        res = {}
+        async with self.db_lock.shared():
+            async with self.db.execute("SELECT Package, Architecture, Version, State, BDUninstallableReasons FROM states") as cursor:
+                async for row in cursor:
+                    res[(row['Package'], row['Architecture'])] = (row['Version'], row['State'], row['BDUninstallableReasons'])
+        return res
+
+    async def expected_build_times(self):
+        res = {}
+        async with self.db_lock.shared():
+            async with self.db.execute("""SELECT Package, avg(PackageTime) AS PackageTime FROM logs
+                WHERE PackageTime IS NOT NULL
+                GROUP BY Package""") as cursor:
+                async for row in cursor:
+                    res[row['Package']] = row['PackageTime']
+        return res
+
+    async def _update_db(self, availpkgs, priorities):
+        await self.db.execute("""DELETE FROM scan""")
+        await self.db.executemany("""INSERT INTO scan (Package, Architecture, Version, State, Reasons, Installed, Buildable, BinNMUVersion)
+            VALUES (:Package, :Architecture, :Version, :State, :Reasons, :Installed, :Buildable, :BinNMUVersion)
+            """, ({'Package': pkg, 'Architecture': arch, 'Version': availentry.version,
+                   'State': self.state_for_avail(availentry), 'Reasons': availentry.reasons_yaml(),
+                   'Installed': availentry.installed, 'Buildable': availentry.buildable,
+                   'BinNMUVersion': availentry.binnmu_version}
+                  for ((pkg, arch), availentry) in availpkgs.items()))
 
-        newpkgs = []
-        obsoletes = []
-        newvers = []
-        newinst = []
-        bduninst_to_needsbuild = []
-        needsbuild_to_bduninst = []
-        bduninst_changed_reasons = []
-        async with self.db.execute("SELECT * FROM states") as cursor:
-            async for row in cursor:
-                if (row['Package'], row['Architecture']) in availpkgs:
-                    availentry = availpkgs[(row['Package'], row['Architecture'])]
-                    availentry['InDB'] = True
-                    if availentry['Version'] != row['Version']:
-                        newvers += [{'RowId': row['RowId'], 'Version': availentry['Version'],
-                                     'State': self.state_for_avail(availentry),
-                                     'Reasons': self.reasons_for_avail(availentry)}]
-                    elif availentry['Installed'] and row['State'] != 'Installed' and availentry['BinNMUVersion'] == row['BinNMUVersion']:
-                        newinst += [{'RowId': row['RowId']}]
-                    elif availentry['Buildable'] and row['State'] == 'BD-Uninstallable':
-                        bduninst_to_needsbuild += [{'RowId': row['RowId']}]
-                    elif not availentry['Buildable'] and row['State'] == 'Needs-Build':
-                        needsbuild_to_bduninst += [{'RowId': row['RowId'], 'Reasons': availentry['Reasons']}]
-                    elif (not availentry['Buildable'] and row['State'] == 'BD-Uninstallable' and
-                          availentry['Reasons'] != row['BDUninstallableReasons']):
-                        bduninst_changed_reasons += [{'RowId': row['RowId'], 'Reasons': availentry['Reasons']}]
-                else:
-                    obsoletes += [{'RowId': row['RowId']}]
-
-            for ((pkg, arch), availentry) in availpkgs.items():
-                if 'InDB' not in availentry:
-                    newpkgs += [{'Package': pkg, 'Architecture': arch, 'Version': availentry['Version'],
-                                 'State': self.state_for_avail(availentry),
-                                 'Reasons': self.reasons_for_avail(availentry)}]
-
-        await self.db.executemany("""INSERT INTO states (Package, Architecture, Version, State, BDUninstallableReasons, Timestamp)
-            VALUES (:Package, :Architecture, :Version, :State, :Reasons, datetime('now'))
-            """, newpkgs)
-        await self.db.executemany("""DELETE FROM states WHERE RowId == :RowId""", obsoletes)
-        await self.db.executemany("""UPDATE states
-            SET Version = :Version,
-                State = :State,
-                BDUninstallableReasons = :Reasons,
+        # the statements below are applied in this order so that each row
+        # undergoes at most one transition, just as if they were tried one
+        # after another for each row in turn
+        counts = {}
+        cursor = await self.db.execute("""DELETE FROM states
+            WHERE NOT EXISTS (SELECT 1 FROM scan WHERE scan.Package == states.Package AND scan.Architecture == states.Architecture)
+            """)
+        counts['obsolete'] = cursor.rowcount
+        cursor = await self.db.execute("""UPDATE states
+            SET Version = scan.Version,
+                State = scan.State,
+                BDUninstallableReasons = CASE WHEN scan.State == 'BD-Uninstallable' THEN scan.Reasons ELSE '' END,
                 Timestamp = datetime('now'),
                 BinNMUVersion = null,
-                BinNMUChangelog = ''
-            WHERE RowId == :RowId
-            """, newvers)
-        await self.db.executemany("""UPDATE states
+                BinNMUChangelog = '',
+                Attempts = 0,
+                RetryAfter = null
+            FROM scan
+            WHERE scan.Package == states.Package AND scan.Architecture == states.Architecture
+                AND scan.Version != states.Version
+            """)
+        counts['new version'] = cursor.rowcount
+        cursor = await self.db.execute("""UPDATE states
             SET State = 'Installed',
                 BDUninstallableReasons = '',
-                Timestamp = datetime('now')
-            WHERE RowId == :RowId
-            """, newinst)
-        await self.db.executemany("""UPDATE states
+                Timestamp = datetime('now'),
+                Attempts = 0,
+                RetryAfter = null
+            FROM scan
+            WHERE scan.Package == states.Package AND scan.Architecture == states.Architecture
+                AND scan.Installed AND states.State != 'Installed' AND scan.BinNMUVersion IS states.BinNMUVersion
+            """)
+        counts['installed'] = cursor.rowcount
+        cursor = await self.db.execute("""UPDATE states
             SET State = 'Needs-Build',
                 BDUninstallableReasons = '',
                 Timestamp = datetime('now')
-            WHERE RowId == :RowId
-            """, bduninst_to_needsbuild)
-        await self.db.executemany("""UPDATE states
+            FROM scan
+            WHERE scan.Package == states.Package AND scan.Architecture == states.Architecture
+                AND scan.Buildable AND states.State == 'BD-Uninstallable'
+            """)
+        counts['BD-Uninstallable -> Needs-Build'] = cursor.rowcount
+        cursor = await self.db.execute("""UPDATE states
             SET State = 'BD-Uninstallable',
-                BDUninstallableReasons = :Reasons,
+                BDUninstallableReasons = scan.Reasons,
                 Timestamp = datetime('now')
-            WHERE RowId == :RowId
-            """, needsbuild_to_bduninst)
-        await self.db.executemany("""UPDATE states
-            SET BDUninstallableReasons = :Reasons
-            WHERE RowId == :RowId
-            """, bduninst_changed_reasons)
+            FROM scan
+            WHERE scan.Package == states.Package AND scan.Architecture == states.Architecture
+                AND NOT scan.Buildable AND states.State == 'Needs-Build'
+            """)
+        counts['Needs-Build -> BD-Uninstallable'] = cursor.rowcount
+        cursor = await self.db.execute("""UPDATE states
+            SET BDUninstallableReasons = scan.Reasons
+            FROM scan
+            WHERE scan.Package == states.Package AND scan.Architecture == states.Architecture
+                AND NOT scan.Buildable AND states.State == 'BD-Uninstallable' AND scan.Reasons IS NOT states.BDUninstallableReasons
+            """)
+        counts['changed reasons'] = cursor.rowcount
+        cursor = await self.db.execute("""INSERT INTO states (Package, Architecture, Version, State, BDUninstallableReasons, Timestamp)
+            SELECT Package, Architecture, Version, State, CASE WHEN State == 'BD-Uninstallable' THEN Reasons ELSE '' END, datetime('now') FROM scan
+            WHERE NOT EXISTS (SELECT 1 FROM states WHERE states.Package == scan.Package AND states.Architecture == scan.Architecture)
+            """)
+        counts['new'] = cursor.rowcount
+        cursor = await self.db.execute("""UPDATE states
+            SET State = 'Needs-Build',
+                Timestamp = datetime('now'),
+                RetryAfter = null
+            FROM scan
+            WHERE scan.Package == states.Package AND scan.Architecture == states.Architecture
+                AND states.RetryAfter <= datetime('now') AND scan.Buildable AND NOT scan.Installed
+            """)
+        counts['retry'] = cursor.rowcount
+
+        await self.db.executemany("""INSERT INTO priorities (Package, Architecture, PriorityBoost)
+            VALUES (:Package, :Architecture, :PriorityBoost)
+            """, ({'Package': pkg, 'Architecture': arch, 'PriorityBoost': boost} for ((pkg, arch), boost) in priorities.items()))
+        await self.db.execute("""UPDATE states
+            SET PriorityBoost = 0
+            WHERE PriorityBoost != 0 AND NOT EXISTS (SELECT 1 FROM priorities WHERE priorities.Package == states.Package AND priorities.Architecture == states.Architecture)
+            """)
+        await self.db.execute("""UPDATE states
+            SET PriorityBoost = priorities.PriorityBoost
+            FROM priorities
+            WHERE priorities.Package == states.Package AND priorities.Architecture == states.Architecture
+            """)
 
+        await self.db.execute("""DELETE FROM scan""")
+        await self.db.execute("""DELETE FROM priorities""")
         await self.db.commit()
 
-        self.db_updated_cond.notify_all()
+        logging.info('State transitions: ' + ', '.join(f'{k}: {v}' for k, v in counts.items()))
+        for transition, count in counts.items():
+            metrics.registry.inc('microbuildd_state_transitions_total', count, transition=transition)
 
     async def register_log(self, loginfo):
-        await self.db.execute("""CREATE TABLE IF NOT EXISTS "logs"
-            ("RowId" INTEGER PRIMARY KEY,
-             "Filename" TEXT UNIQUE,
-             "Package" TEXT,
-             "Version" TEXT,
-             "Status" TEXT,
-             "PackageTime" INTEGER,
-             "Space" INTEGER,
-             "StartTimestamp" TEXT,
-             "EndTimestamp" TEXT)
-            """)
-        await self.db.execute("""
-            INSERT INTO logs (Filename, Package, Version, Status, PackageTime, Space, StartTimestamp, EndTimestamp)
-                VALUES (:Filename, :Package, :Version, :Status, :PackageTime, :Space, datetime(:StartTimestamp), datetime(:EndTimestamp))
-            """, loginfo)
-        await self.db.commit()
+        await self.write(lambda: self._register_log(loginfo))
+
+    async def _register_log(self, loginfo):
+        cursor = await self.db.execute("""
+            INSERT INTO logs (Filename, Package, Version, Status, PackageTime, Space, StartTimestamp, EndTimestamp,
+                              UserTime, SystemTime, MaxRSS, IOReadBytes, IOWriteBytes,
+                              CacheHits, CacheMisses, CacheHitBytes, CacheMissBytes, Tmpfs, Worker, FailureSignature)
+                VALUES (:Filename, :Package, :Version, :Status, :PackageTime, :Space, datetime(:StartTimestamp), datetime(:EndTimestamp),
+                        :UserTime, :SystemTime, :MaxRSS, :IOReadBytes, :IOWriteBytes,
+                        :CacheHits, :CacheMisses, :CacheHitBytes, :CacheMissBytes, :Tmpfs, :Worker, :FailureSignature)
+            """, {**dict.fromkeys(LOG_RESOURCE_FIELDS + LOG_CACHE_FIELDS + ('PackageTime', 'Space', 'Tmpfs', 'Worker', 'FailureSignature')),
+                  **loginfo})
+        if loginfo.get('FailureExcerpt'):
+            await self._index_failure(cursor.lastrowid, loginfo['FailureExcerpt'])
+
+    async def _index_failure(self, rowid, excerpt):
+        if self.failure_search:
+            await self.db.execute("""INSERT INTO log_failures (rowid, Excerpt) VALUES (:RowId, :Excerpt)
+                """, {'RowId': rowid, 'Excerpt': excerpt})
+
+    async def unindexed_failure_logs(self, after, limit):
+        """
+        Return the RowId and Filename of up to limit logs of failed builds
+        after RowId after which have no FailureSignature yet
+        """
+        async with self.db_lock.shared():
+            async with self.db.execute("""SELECT RowId, Filename FROM logs
+                WHERE RowId > :After AND FailureSignature IS NULL AND Status != "successful"
+                ORDER BY RowId
+                LIMIT :Limit""", {'After': after, 'Limit': limit}) as cursor:
+                return [(row['RowId'], row['Filename']) async for row in cursor]
+
+    async def add_failure_info(self, infos):
+        """
+        Record the failure_info() of logs, infos mapping their RowId to it
+        """
+        async def add():
+            for rowid, info in infos.items():
+                await self.db.execute("""UPDATE logs SET FailureSignature = :FailureSignature WHERE RowId == :RowId
+                    """, {'RowId': rowid, 'FailureSignature': info['FailureSignature']})
+                if info['FailureExcerpt']:
+                    await self._index_failure(rowid, info['FailureExcerpt'])
+        await self.write(add)
 
     class BuildLease(object):
         statesdb = None
@@ -176,8 +453,11 @@ class States(object):
         build_result = None
         first_time = False
         event_to_signal_on_failure = None
+        admission = None
+        architectures = None
+        timeout = None
         
-        def __init__(self, statesdb, first_time, event_to_signal_on_failure):
+        def __init__(self, statesdb, first_time, event_to_signal_on_failure, admission, architectures, timeout):
             self.statesdb = statesdb
             self.package = None
             self.architecture = None
@@ -187,58 +467,179 @@ class States(object):
             self.build_result = None
             self.first_time = first_time
             self.event_to_signal_on_failure = event_to_signal_on_failure
+            self.admission = admission
+            self.architectures = architectures
+            self.timeout = timeout
 
         async def __aenter__(self):
-            (self.package, self.architecture, self.version, self.binnmu_version, self.binnmu_changelog) = await self.statesdb._get_package_to_build(self.first_time, self.event_to_signal_on_failure)
+            leased = await self.statesdb._get_package_to_build(self.first_time, self.event_to_signal_on_failure, self.admission,
+                                                               self.architectures, self.timeout)
+            # only with a timeout, package stays None if nothing was leased
+            if leased is not None:
+                (self.package, self.architecture, self.version, self.binnmu_version, self.binnmu_changelog) = leased
             return self
 
-        async def set_build_result(self, newstate):
+        async def set_build_result(self, newstate, loginfo=None):
             self.build_result = newstate
-            await self.statesdb.register_build_result(self.package, self.architecture, self.version, self.binnmu_version, newstate)
+            await self.statesdb.register_build_result(self.package, self.architecture, self.version, self.binnmu_version, newstate,
+                                                      retryable(newstate, loginfo))
+
+        async def release(self):
+            """
+            Return the package to Needs-Build without a build result, e.g.
+            because the remote worker building it went away
+            """
+            await self.set_build_result('Needs-Build')
 
         async def __aexit__(self, *exc):
-            if self.package is not None and self.build_result is None:
-                logging.info(f'Build lease for {self.package} version {self.versionstr()} terminated unexpectedly, setting State to Internal-Error')
-                await self.set_build_result('Internal-Error')
+            try:
+                if self.package is not None and self.build_result is None:
+                    logging.info(f'Build lease for {self.package} version {self.versionstr()} terminated unexpectedly, setting State to Internal-Error')
+                    await self.set_build_result('Internal-Error')
+            finally:
+                if self.package is not None and self.admission is not None:
+                    self.admission.finish((self.package, self.architecture))
+                    # the resources freed up might let another build start
+                    async with self.statesdb.db_updated_cond:
+                        self.statesdb.db_updated_cond.notify_all()
 
         def versionstr(self):
             return self.version if self.binnmu_version is None else f'{self.version}+b{self.binnmu_version}'
 
-    def get_package_to_build(self, first_time, event_to_signal_on_failure):
-        return States.BuildLease(self, first_time, event_to_signal_on_failure)
+    def get_package_to_build(self, first_time, event_to_signal_on_failure, admission=None, architectures=None, timeout=None):
+        """
+        Lease the next package to build, only considering the given
+        architectures if not None.  With a timeout, gives up waiting for
+        something to build after that many seconds, leaving the lease's
+        package None.
+        """
+        return States.BuildLease(self, first_time, event_to_signal_on_failure, admission, architectures, timeout)
+
+    async def _get_package_to_build(self, first_time, event_to_signal_on_failure, admission, architectures, timeout):
+        with metrics.registry.timer('microbuildd_lease_wait_seconds'):
+            return await self._lease_package(first_time, event_to_signal_on_failure, admission, architectures, timeout)
 
-    async def _get_package_to_build(self, first_time, event_to_signal_on_failure):
-        do_signal = not first_time
-        while True:
-            async with self.db.execute("""SELECT * FROM states WHERE State == "Needs-Build"
-                ORDER BY Timestamp ASC, Package ASC, Architecture ASC
-                LIMIT 1""") as cursor:
-                async for row in cursor:
-                    await self.db.execute("""UPDATE states
-                        SET State = "Building",
-                            Timestamp = datetime('now')
-                        WHERE RowId == :RowId""",
-                        {'RowId': row['RowId']})
-                    await self.db.commit()
+    async def _lease_package(self, first_time, event_to_signal_on_failure, admission, architectures, timeout):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout if timeout is not None else None
+        # all build workers lease while holding db_updated_cond's lock, so two
+        # workers can never be handed the same (Package, Architecture) row
+        async with self.db_updated_cond:
+            do_signal = not first_time
+            while True:
+                async with self.db_lock.shared():
+                    async with self.db.execute("""SELECT * FROM states WHERE State == "Needs-Build"
+                        AND (:Architectures IS NULL OR Architecture IN (SELECT value FROM json_each(:Architectures)))
+                        ORDER BY SchedKey ASC, Package ASC, Architecture ASC
+                        LIMIT :Limit""", {'Limit': 1 if admission is None else conf.admission_lookahead,
+                                          'Architectures': json.dumps(architectures) if architectures is not None else None}) as cursor:
+                        candidates = {(row['Package'], row['Architecture']): row async for row in cursor}
+
+                key = None
+                if candidates:
+                    key = next(iter(candidates)) if admission is None else admission.choose(list(candidates))
+                # the lock is not held while claiming, as the writer needs it
+                # too, so an update() may have got in between
+                if key is not None and await self._claim_or_release(candidates[key]):
+                    row = candidates[key]
+                    if admission is not None:
+                        admission.start(key)
                     return (row['Package'], row['Architecture'], row['Version'], row['BinNMUVersion'], row['BinNMUChangelog'])
+                elif key is not None:
+                    continue
+
+                if candidates:
+                    # there is work, but not enough resources to start it;
+                    # wait for a build to finish or resources to free up
+                    try:
+                        await asyncio.wait_for(self.db_updated_cond.wait(), timeout=conf.admission_recheck_interval)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                if do_signal:
+                    event_to_signal_on_failure.set()
+                    do_signal = False
+
+                if deadline is None:
+                    await self.db_updated_cond.wait()
+                    continue
+                try:
+                    await asyncio.wait_for(self.db_updated_cond.wait(), timeout=deadline - loop.time())
+                except asyncio.TimeoutError:
+                    return None
+
+    async def _claim_or_release(self, row):
+        """
+        Claim row for building, returning whether that worked.  If this is
+        cancelled, the claim still goes ahead but nobody would ever build
+        the package, so it goes back to Needs-Build.
+        """
+        claim = asyncio.ensure_future(self.write(lambda: self._claim(row), urgent=True))
+        try:
+            return await asyncio.shield(claim)
+        except asyncio.CancelledError:
+            if await claim:
+                await self.register_build_result(row['Package'], row['Architecture'], row['Version'], row['BinNMUVersion'],
+                                                 'Needs-Build')
+            raise
+
+    async def _claim(self, row):
+        cursor = await self.db.execute("""UPDATE states
+            SET State = "Building",
+                Timestamp = datetime('now')
+            WHERE RowId == :RowId AND State == "Needs-Build" AND Version == :Version AND BinNMUVersion IS :BinNMUVersion""",
+            {'RowId': row['RowId'], 'Version': row['Version'], 'BinNMUVersion': row['BinNMUVersion']})
+        return cursor.rowcount == 1
 
-            if do_signal:
-                event_to_signal_on_failure.set()
-                do_signal = False
+    async def collect_metrics(self):
+        async with self.metrics_db.execute("""SELECT State, count(*) AS Count FROM states GROUP BY State""") as cursor:
+            counts = {row['State']: row['Count'] async for row in cursor}
+        metrics.registry.clear('microbuildd_packages')
+        for state, count in counts.items():
+            metrics.registry.set('microbuildd_packages', count, state=state)
 
-            await self.db_updated_cond.wait()
+    async def build_estimates(self):
+        res = {}
+        async with self.db_lock.shared():
+            # CPU use is estimated as how many CPUs the build kept busy on
+            # average, from its CPU time and how long it took
+            async with self.db.execute("""SELECT Package, max(Space) AS Space, max(MaxRSS) AS MaxRSS,
+                    avg(CASE WHEN PackageTime > 0 THEN (UserTime + SystemTime) / PackageTime END) AS Cpus
+                FROM logs
+                WHERE Space IS NOT NULL OR MaxRSS IS NOT NULL OR UserTime IS NOT NULL
+                GROUP BY Package""") as cursor:
+                async for row in cursor:
+                    # sbuild reports disk space in KiB
+                    res[row['Package']] = (row['Space'] * 1024 if row['Space'] is not None else None, row['MaxRSS'], row['Cpus'])
+        return res
+
+    async def register_build_result(self, package, architecture, version, binnmu_version, newstate, retry=False):
+        await self.write(lambda: self._register_build_result(package, architecture, version, binnmu_version, newstate, retry))
 
-    async def register_build_result(self, package, architecture, version, binnmu_version, newstate):
+    async def _register_build_result(self, package, architecture, version, binnmu_version, newstate, retry):
+        # SET expressions see the old Attempts, so the n-th failure is
+        # retried after retry_base_delay * 2^(n-1)
+        params = {'Package': package, 'Architecture': architecture, 'Version': version, 'BinNMUVersion': binnmu_version, 'Newstate': newstate,
+                  'Failed': newstate not in ('Uploaded', 'Needs-Build'), 'Retry': retry, 'MaxAttempts': conf.retry_max_attempts,
+                  'BaseDelay': conf.retry_base_delay, 'MaxDelay': conf.retry_max_delay}
         if binnmu_version is None:
             await self.db.execute("""UPDATE states
                 SET State = :Newstate,
-                    Timestamp = datetime('now')
+                    Timestamp = datetime('now'),
+                    Attempts = Attempts + :Failed,
+                    RetryAfter = CASE WHEN :Retry AND Attempts + 1 < :MaxAttempts
+                        THEN datetime('now', printf('+%d seconds', min(:MaxDelay, :BaseDelay * (1 << min(Attempts, 30)))))
+                        ELSE null END
                 WHERE Package == :Package AND Architecture == :Architecture AND Version == :Version AND BINNMUVersion IS NULL AND State == "Building"
-                """, {'Package': package, 'Architecture': architecture, 'Version': version, 'BinNMUVersion': binnmu_version, 'Newstate': newstate})
+                """, params)
         else:
             await self.db.execute("""UPDATE states
                 SET State = :Newstate,
-                    Timestamp = datetime('now')
+                    Timestamp = datetime('now'),
+                    Attempts = Attempts + :Failed,
+                    RetryAfter = CASE WHEN :Retry AND Attempts + 1 < :MaxAttempts
+                        THEN datetime('now', printf('+%d seconds', min(:MaxDelay, :BaseDelay * (1 << min(Attempts, 30)))))
+                        ELSE null END
                 WHERE Package == :Package AND Architecture == :Architecture AND Version == :Version AND BinNMUVersion == :BinNMUVersion AND State == "Building"
-                """, {'Package': package, 'Architecture': architecture, 'Version': version, 'BinNMUVersion': binnmu_version, 'Newstate': newstate})
-        await self.db.commit()
+                """, params)
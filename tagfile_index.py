@@ -0,0 +1,109 @@
+import apt_pkg, hashlib, json, logging, os, re, sqlite3
+import micro_buildd_conf as conf
+
+class TagFileIndex(object):
+    """
+    Persistent index of the fields we care about from Sources or Packages
+    style files.  Files are keyed by path plus size and mtime, so an
+    unchanged file is never re-parsed; when a file has changed, only the
+    stanzas whose contents differ from the previously indexed version of
+    the file are parsed again.
+    """
+
+    kind = None
+    fields = None
+    db = None
+    cache = None
+
+    def __init__(self, kind, fields):
+        # changing the set of indexed fields invalidates what is on disk
+        self.kind = f'{kind}:{",".join(fields)}'
+        self.fields = fields
+        self.db = None
+        self.cache = {}
+
+    def ensure_db(self):
+        if self.db is not None:
+            return
+        self.db = sqlite3.connect(conf.index_database_path)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS "index_files"
+            ("Kind" TEXT,
+             "Path" TEXT,
+             "Size" INTEGER,
+             "MTime" INTEGER,
+             "Digest" BLOB,
+             PRIMARY KEY("Kind", "Path"))
+            """)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS "index_stanzas"
+            ("Kind" TEXT,
+             "Path" TEXT,
+             "Position" INTEGER,
+             "Digest" BLOB,
+             "Fields" TEXT,
+             PRIMARY KEY("Kind", "Path", "Position"))
+            """)
+        self.db.commit()
+
+    def load_stanzas(self, path):
+        return [(row[0], json.loads(row[1])) for row in self.db.execute("""SELECT Digest, Fields FROM index_stanzas
+            WHERE Kind == :Kind AND Path == :Path
+            ORDER BY Position ASC
+            """, {'Kind': self.kind, 'Path': str(path)})]
+
+    def parse_stanza(self, stanza):
+        section = apt_pkg.TagSection(stanza.decode('utf-8', 'replace'))
+        return {field: section[field] for field in self.fields if field in section}
+
+    def paragraphs(self, path):
+        """
+        Return a list of dicts, one per stanza of path, containing those of
+        self.fields which are present in the stanza
+        """
+        st = os.stat(path)
+        cached = self.cache.get(path)
+        if cached is not None and cached[0] == (st.st_size, st.st_mtime_ns):
+            return cached[1]
+
+        self.ensure_db()
+        row = self.db.execute("""SELECT Size, MTime, Digest FROM index_files WHERE Kind == :Kind AND Path == :Path""",
+                              {'Kind': self.kind, 'Path': str(path)}).fetchone()
+        if row is not None and (row[0], row[1]) == (st.st_size, st.st_mtime_ns):
+            res = [fields for digest, fields in self.load_stanzas(path)]
+        else:
+            with open(path, 'rb') as fh:
+                contents = fh.read()
+            digest = hashlib.sha256(contents).digest()
+            if row is not None and row[2] == digest:
+                res = [fields for digest, fields in self.load_stanzas(path)]
+            else:
+                res = self.reindex(path, contents)
+            self.db.execute("""INSERT OR REPLACE INTO index_files (Kind, Path, Size, MTime, Digest)
+                VALUES (:Kind, :Path, :Size, :MTime, :Digest)
+                """, {'Kind': self.kind, 'Path': str(path), 'Size': st.st_size, 'MTime': st.st_mtime_ns, 'Digest': digest})
+            self.db.commit()
+
+        self.cache[path] = ((st.st_size, st.st_mtime_ns), res)
+        return res
+
+    def reindex(self, path, contents):
+        old = dict(self.load_stanzas(path))
+        stanzas = []
+        reparsed = 0
+        for stanza in re.split(b'\n\n+', contents):
+            if not stanza.strip():
+                continue
+            digest = hashlib.blake2b(stanza, digest_size=16).digest()
+            fields = old.get(digest)
+            if fields is None:
+                fields = self.parse_stanza(stanza)
+                reparsed += 1
+            stanzas.append((digest, fields))
+        logging.info(f'Indexed {path}: {reparsed} of {len(stanzas)} stanzas changed')
+
+        self.db.execute("""DELETE FROM index_stanzas WHERE Kind == :Kind AND Path == :Path""",
+                        {'Kind': self.kind, 'Path': str(path)})
+        self.db.executemany("""INSERT INTO index_stanzas (Kind, Path, Position, Digest, Fields)
+            VALUES (:Kind, :Path, :Position, :Digest, :Fields)
+            """, ({'Kind': self.kind, 'Path': str(path), 'Position': i, 'Digest': digest, 'Fields': json.dumps(fields)}
+                  for i, (digest, fields) in enumerate(stanzas)))
+        return [fields for digest, fields in stanzas]
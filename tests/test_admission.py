@@ -0,0 +1,130 @@
+import os, sys, tempfile, time, unittest
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import micro_buildd_conf as conf
+import admission
+
+GiB = 1024 ** 3
+
+class AdmissionTest(unittest.TestCase):
+    def setUp(self):
+        saved = {name: getattr(conf, name) for name in ('admission_min_free_space', 'admission_min_free_memory', 'admission_max_load',
+                                                         'admission_max_wait', 'rebuild_tmpfs_build_dir', 'rebuild_tmpfs_budget')}
+        self.addCleanup(lambda: [setattr(conf, name, value) for name, value in saved.items()])
+        conf.admission_min_free_space = 0
+        conf.admission_min_free_memory = 0
+        conf.admission_max_load = 1
+        conf.admission_max_wait = 60
+        conf.rebuild_tmpfs_build_dir = None
+        conf.rebuild_tmpfs_budget = 4 * GiB
+        self.free_space = 100 * GiB
+        self.free_memory = 100 * GiB
+        for target, fn in (('shutil.disk_usage', lambda path: mock.Mock(free=self.free_space)),
+                           ('admission.mem_available', lambda: self.free_memory),
+                           ('os.getloadavg', lambda: (0, 0, 0)),
+                           ('os.cpu_count', lambda: 4)):
+            patcher = mock.patch(target, fn)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.admission = admission.AdmissionController()
+        # package: (space, memory, cpus)
+        self.admission.estimates = {
+            'big': (10 * GiB, GiB, 1),
+            'small': (GiB, GiB, 1),
+            'parallel': (GiB, GiB, 4),
+        }
+
+    def start(self, package):
+        key = (package, 'amd64')
+        self.assertEqual(self.admission.choose([key]), key)
+        self.admission.start(key)
+        return key
+
+    def test_first_build_always_starts(self):
+        self.free_space = 0
+        self.assertEqual(self.admission.choose([('big', 'amd64')]), ('big', 'amd64'))
+
+    def test_only_remaining_growth_of_running_builds_counts(self):
+        key = self.start('big')
+        self.admission.build_started(key, Path('/nonexistent'), os.getpid())
+        # what the running build uses already isn't free anymore
+        self.free_space = 3 * GiB
+        self.assertIsNone(self.admission.choose([('small', 'amd64')]))
+        self.admission.usage[key] = (Path('/nonexistent'), os.getpid(), 7 * GiB, 0)
+        self.assertIsNone(self.admission.choose([('small', 'amd64')]))
+        self.admission.usage[key] = (Path('/nonexistent'), os.getpid(), 9 * GiB, 0)
+        self.assertEqual(self.admission.choose([('small', 'amd64')]), ('small', 'amd64'))
+
+    def test_memory_of_running_builds(self):
+        key = self.start('small')
+        self.free_memory = 1.5 * GiB
+        self.assertIsNone(self.admission.choose([('small', 'i386')]))
+        self.admission.build_started(key, Path('/nonexistent'), os.getpid())
+        self.admission.usage[key] = (Path('/nonexistent'), os.getpid(), 0, GiB)
+        self.assertEqual(self.admission.choose([('small', 'i386')]), ('small', 'i386'))
+
+    def test_cpus(self):
+        self.start('parallel')
+        self.assertIsNone(self.admission.choose([('small', 'amd64')]))
+
+    def test_backfill(self):
+        self.start('small')
+        self.free_space = 5 * GiB
+        candidates = [('big', 'amd64'), ('small', 'i386')]
+        self.assertEqual(self.admission.choose(candidates), ('small', 'i386'))
+        with mock.patch('time.monotonic', lambda: time.time() + 2 * conf.admission_max_wait):
+            self.assertIsNone(self.admission.choose(candidates))
+
+    def test_tmpfs(self):
+        conf.rebuild_tmpfs_build_dir = Path('/nonexistent')
+        conf.admission_max_load = 2
+        key = self.start('small')
+        self.assertTrue(self.admission.uses_tmpfs(key))
+        # a build on tmpfs doesn't need disk space
+        self.free_space = 0
+        self.assertEqual(self.admission.choose([('small', 'i386')]), ('small', 'i386'))
+        self.admission.start(('small', 'i386'))
+        self.assertTrue(self.admission.uses_tmpfs(('small', 'i386')))
+        # 2 GiB are left of the budget
+        self.assertTrue(self.admission.fits_tmpfs('small'))
+        self.assertFalse(self.admission.fits_tmpfs('big'))
+        self.admission.start(('small', 'armhf'))
+        self.admission.start(('small', 'arm64'))
+        self.assertFalse(self.admission.fits_tmpfs('small'))
+        self.assertIsNone(self.admission.choose([('small', 'ppc64el')]))
+        self.free_space = 100 * GiB
+        self.assertEqual(self.admission.choose([('small', 'ppc64el')]), ('small', 'ppc64el'))
+        self.admission.start(('small', 'ppc64el'))
+        self.assertFalse(self.admission.uses_tmpfs(('small', 'ppc64el')))
+
+    def test_tmpfs_needs_memory(self):
+        conf.rebuild_tmpfs_build_dir = Path('/nonexistent')
+        self.free_memory = 1.5 * GiB
+        self.assertFalse(self.admission.fits_tmpfs('small'))
+        self.free_memory = 2 * GiB
+        self.assertTrue(self.admission.fits_tmpfs('small'))
+
+    def test_tmpfs_needs_known_space(self):
+        conf.rebuild_tmpfs_build_dir = Path('/nonexistent')
+        self.assertFalse(self.admission.fits_tmpfs('unknown'))
+
+class UsageTest(unittest.TestCase):
+    def test_dir_usage(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            (Path(tmpdir) / 'sub').mkdir()
+            with open(Path(tmpdir) / 'sub' / 'file', 'wb') as fh:
+                fh.write(os.urandom(1024 * 1024))
+                fh.flush()
+                os.fsync(fh.fileno())
+            self.assertGreaterEqual(admission.dir_usage(tmpdir), 1024 * 1024)
+
+    def test_process_tree_rss(self):
+        rss = admission.process_tree_rss([os.getpid(), os.getppid()])
+        self.assertGreater(rss[os.getpid()], 0)
+        self.assertGreaterEqual(rss[os.getppid()], rss[os.getpid()])
+
+if __name__ == '__main__':
+    unittest.main()
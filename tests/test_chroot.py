@@ -0,0 +1,143 @@
+import asyncio, sys, tempfile, unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import micro_buildd_conf as conf
+import chroot, failures
+
+SUMMARY = (b'\n+------+\n| Summary |\n+------+\n\nStatus: attempted\nFail-Stage: build\n' + b'-' * 80 + b'\n'
+           b'Finished at 2026-01-01T00:00:00Z\nBuild needed 00:00:01, 1k disk space\n')
+
+class ReadLogTailTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.logpath = Path(self.tmpdir.name) / 'hello_1.0-1_amd64-2026-01-01T00:00:00Z.build'
+        # nothing read_log_tail() needs is set up in __init__
+        self.chroot = chroot.Chroot.__new__(chroot.Chroot)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_summary_spanning_chunks(self):
+        line = b'x' * 99 + b'\n'
+        self.logpath.write_bytes(line * (3 * chroot.LOG_CHUNK_SIZE // len(line)) + SUMMARY)
+        loglines = self.chroot.read_log_tail(self.logpath)
+        self.assertEqual(loglines, self.logpath.read_bytes().splitlines()[-len(loglines):])
+        self.assertIn(b'Finished at 2026-01-01T00:00:00Z', loglines)
+        self.assertLess(len(loglines), 2 * chroot.LOG_CHUNK_SIZE // len(line))
+
+    def test_summary_end_starting_chunk(self):
+        # the line before 'Finished at' straddles the start of the last
+        # chunk, with a blank line among those following it
+        head, finished = SUMMARY.split(b'Finished at')
+        line = b'y' * 99 + b'\n'
+        trailer = b'Finished at' + finished + b'\n'
+        filler = chroot.LOG_CHUNK_SIZE - 40 - len(trailer)
+        trailer += line * (filler // len(line)) + b'y' * (filler % len(line) - 1) + b'\n'
+        self.logpath.write_bytes(line * 100 + head + trailer)
+        loglines = self.chroot.read_log_tail(self.logpath)
+        self.assertIn(b'Status: attempted', loglines)
+        self.assertEqual(loglines, self.logpath.read_bytes().splitlines()[-len(loglines):])
+
+    def test_long_summary(self):
+        # more than LOG_TAIL_LINES lines and LOG_CHUNK_SIZE bytes
+        head, tail = SUMMARY.split(b'Fail-Stage')
+        notes = b''.join(b'Note-%d: %s\n' % (i, b'z' * 400) for i in range(chroot.LOG_TAIL_LINES + 1000))
+        self.logpath.write_bytes(b'x' * 99 + b'\n' + head + notes + b'Fail-Stage' + tail)
+        loglines = self.chroot.read_log_tail(self.logpath)
+        self.assertIn(b'Status: attempted', loglines)
+        self.assertEqual(loglines, self.logpath.read_bytes().splitlines()[-len(loglines):])
+
+    def test_short_log(self):
+        self.logpath.write_bytes(b'first\n' + SUMMARY)
+        self.assertEqual(self.chroot.read_log_tail(self.logpath), self.logpath.read_bytes().splitlines())
+
+    def test_no_summary(self):
+        line = b'x' * 9 + b'\n'
+        self.logpath.write_bytes(line * (4 * chroot.LOG_TAIL_BYTES // len(line)))
+        loglines = self.chroot.read_log_tail(self.logpath)
+        self.assertGreaterEqual(len(loglines), chroot.LOG_TAIL_LINES)
+        self.assertLessEqual(len(loglines) * len(line), chroot.LOG_TAIL_BYTES + chroot.LOG_CHUNK_SIZE)
+
+class ArchiveLogTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.addCleanup(setattr, conf, 'rebuild_logs_dir', conf.rebuild_logs_dir)
+        self.addCleanup(setattr, conf, 'log_compression', conf.log_compression)
+        conf.rebuild_logs_dir = Path(self.tmpdir.name) / 'logs'
+        conf.rebuild_logs_dir.mkdir()
+        self.logpath = Path(self.tmpdir.name) / 'hello_1.0-1_amd64-2026-01-01T00:00:00Z.build'
+        self.chroot = chroot.Chroot.__new__(chroot.Chroot)
+
+    def archive(self, compression):
+        conf.log_compression = compression
+        self.logpath.write_bytes(b'first\n' + SUMMARY)
+        path = self.chroot.archive_log(self.logpath)
+        self.assertFalse(self.logpath.exists())
+        self.assertEqual(failures.read_archived_tail(path), (b'first\n' + SUMMARY).splitlines(keepends=True))
+        return path
+
+    def test_xz(self):
+        self.assertEqual(self.archive('xz').name, self.logpath.name + '.xz')
+
+    def test_gzip(self):
+        self.assertEqual(self.archive('gzip').name, self.logpath.name + '.gz')
+
+    @unittest.skipIf(failures.zstandard is None, 'needs the zstandard module')
+    def test_zstd(self):
+        self.assertEqual(self.archive('zstd').name, self.logpath.name + '.zst')
+
+    def test_uncompressed(self):
+        self.assertEqual(self.archive(None).name, self.logpath.name)
+
+class GenerationTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.link = Path(self.tmpdir.name) / 'rebuild-amd64'
+        self.addCleanup(setattr, conf, 'rebuild_archs', conf.rebuild_archs)
+        self.addCleanup(setattr, conf, 'sbuild_chroot_path', conf.sbuild_chroot_path)
+        conf.rebuild_archs = ['amd64']
+        conf.sbuild_chroot_path = lambda arch: self.link
+        self.chroot = chroot.Chroot(None)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def generation(self, name):
+        gen = self.link.with_name(f'{self.link.name}.gen-{name}')
+        (gen / 'etc').mkdir(parents=True)
+        return gen
+
+    def generations(self):
+        return sorted(p.name for p in self.link.parent.glob('*.gen-*'))
+
+    async def test_stale_generations_removed_on_startup(self):
+        self.generation('1')
+        self.generation('2')
+        self.link.symlink_to('rebuild-amd64.gen-2')
+        await self.chroot.remove_stale_generations()
+        self.assertEqual(self.generations(), ['rebuild-amd64.gen-2'])
+
+    async def test_generation_removed_after_last_build(self):
+        self.generation('1')
+        self.link.symlink_to('rebuild-amd64.gen-1')
+        unblock = asyncio.Event()
+        async def build(build_lease, statesdb):
+            await unblock.wait()
+        self.chroot._build = build
+        lease = type('Lease', (), {'architecture': 'amd64'})()
+        task = asyncio.create_task(self.chroot._build_in_chroot(lease, None))
+        await asyncio.sleep(0)
+        # swapped out by an update while the build is running
+        self.generation('2')
+        self.chroot.replace_symlink(self.link, 'rebuild-amd64.gen-2')
+        await self.chroot.remove_retired_generations('amd64', self.link)
+        self.assertEqual(self.generations(), ['rebuild-amd64.gen-1', 'rebuild-amd64.gen-2'])
+        unblock.set()
+        await task
+        self.assertEqual(self.generations(), ['rebuild-amd64.gen-2'])
+
+if __name__ == '__main__':
+    unittest.main()
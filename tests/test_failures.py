@@ -0,0 +1,62 @@
+import gzip, lzma, sys, tempfile, unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import failures
+
+def log(*build_output):
+    return ([b'+------+', b'| Build |', b'+------+', b''] + [l.encode() for l in build_output] +
+            [b'make: *** [debian/rules:8: binary] Error 2', b'dpkg-buildpackage: error: debian/rules binary subprocess returned exit status 2',
+             b'', b'Build finished at 2026-01-01T00:00:00Z', b'', b'+------+', b'| Summary |', b'+------+', b'', b'Status: attempted'])
+
+class SignatureTest(unittest.TestCase):
+    def test_normalized(self):
+        self.assertEqual(failures.signature('/build/hello-Ab3xYz/src/main.c:12:5: error: expected ; at 0x7ffd1234'),
+                         failures.signature('/build/hello-Qr9TuV/src/main.c:40:1:  error: expected ;   at 0xDEADBEEF'))
+
+    def test_distinct(self):
+        self.assertNotEqual(failures.signature('main.c:12:5: error: expected ;'),
+                            failures.signature('main.c:12:5: error: unknown type name'))
+
+    def test_surrounding_whitespace(self):
+        self.assertEqual(failures.signature('  error: x\n'), failures.signature('error: x'))
+
+class FailureInfoTest(unittest.TestCase):
+    def test_same_failure_same_signature(self):
+        first = failures.failure_info(log('gcc -O2 -c main.c', '/build/hello-Ab3xYz/main.c:12:5: error: expected ;'))
+        second = failures.failure_info(log('gcc -O2 -g -c main.c', '/build/hello-Qr9TuV/main.c:14:2: error: expected ;'))
+        self.assertEqual(first['FailureSignature'], second['FailureSignature'])
+        self.assertEqual(first['FailureExcerpt'], '/build/hello-Ab3xYz/main.c:12:5: error: expected ;')
+
+    def test_generic_errors_left_out(self):
+        info = failures.failure_info(log('checking for foo... no', 'configure: error: foo is required'))
+        self.assertEqual(info['FailureExcerpt'], 'configure: error: foo is required')
+
+    def test_no_error_lines(self):
+        info = failures.failure_info([b'Fetching hello 1.0-1', b'', b'Could not download the source'])
+        self.assertEqual(info['FailureExcerpt'], 'Fetching hello 1.0-1\nCould not download the source')
+
+    def test_empty(self):
+        self.assertEqual(failures.failure_info([]), {'FailureExcerpt': '', 'FailureSignature': ''})
+
+class ArchivedFailureInfoTest(unittest.TestCase):
+    def test_compressed(self):
+        loglines = log('/build/hello-Ab3xYz/main.c:12:5: error: expected ;')
+        expected = failures.failure_info(loglines)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for opener, suffix in ((open, ''), (gzip.open, '.gz'), (lzma.open, '.xz')):
+                path = Path(tmpdir) / f'hello.build{suffix}'
+                with opener(path, 'wb') as fh:
+                    fh.write(b'\n'.join(loglines) + b'\n')
+                self.assertEqual(failures.archived_failure_info(path), expected)
+
+    def test_unreadable(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / 'hello.build.xz'
+            path.write_bytes(b'not xz')
+            with self.assertLogs(level='WARNING'):
+                self.assertEqual(failures.archived_failure_info(path), {'FailureExcerpt': '', 'FailureSignature': ''})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import importlib.machinery, importlib.util, sys, tempfile, unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import micro_buildd_conf as conf
+
+# the script has no .py suffix
+loader = importlib.machinery.SourceFileLoader('make_binnmu', str(Path(__file__).resolve().parent.parent / 'make_binnmu'))
+make_binnmu = importlib.util.module_from_spec(importlib.util.spec_from_loader(loader.name, loader))
+loader.exec_module(make_binnmu)
+
+SOURCES = """Package: direct
+Version: 1.0-1
+Build-Depends: debhelper-compat (= 13), libfoo-dev (>= 1.2) [linux-any] <!nocheck>
+
+Package: direct
+Version: 1.0-2
+Build-Depends: debhelper-compat (= 13), libfoo-dev (>= 1.2) [linux-any] <!nocheck>
+
+Package: alternative
+Version: 2.0-1
+Build-Depends-Indep: libbar-dev | libfoo-dev:native
+
+Package: arch
+Version: 3.0-1
+Build-Depends-Arch: libfoo-dev
+
+Package: conflicts
+Version: 4.0-1
+Build-Depends: debhelper-compat (= 13)
+Build-Conflicts: libfoo-dev
+
+Package: indirect
+Version: 5.0-1
+Build-Depends: libfoo-tools
+
+Package: prefix
+Version: 6.0-1
+Build-Depends: libfoo-dev-doc
+
+Package: eso
+Version: 7.0-1
+Extra-Source-Only: yes
+Build-Depends: libfoo-dev
+"""
+
+class RdepsBinnmusTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.addCleanup(setattr, conf, 'apt_sources_path', conf.apt_sources_path)
+        conf.apt_sources_path = Path(self.tmpdir.name) / 'Sources'
+        conf.apt_sources_path.write_text(SOURCES)
+
+    def test_rdeps(self):
+        self.assertEqual(make_binnmu.rdeps_binnmus('libfoo-dev', 'Rebuild against libfoo2'), [
+            ('alternative', '2.0-1', 'Rebuild against libfoo2'),
+            ('arch', '3.0-1', 'Rebuild against libfoo2'),
+            ('direct', '1.0-2', 'Rebuild against libfoo2'),
+        ])
+
+    def test_no_rdeps(self):
+        self.assertEqual(make_binnmu.rdeps_binnmus('libunused-dev', 'Rebuild'), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import math, sys, unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import micro_buildd_conf as conf
+import repo, scheduler
+
+def missing(name):
+    return [{'missing': {'pkg': {'package': 'src:x', 'architecture': 'amd64', 'version': '1', 'unsat-dependency': f'{name} (>= 1)'}}}]
+
+def entry(installed=False, buildable=False, reasons=None):
+    res = repo.ScanEntry('1')
+    res.installed = installed
+    if buildable:
+        res.set_buildable()
+    elif reasons is not None:
+        res.set_unbuildable(reasons)
+    return res
+
+class ComputePrioritiesTest(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(setattr, conf, 'rebuild_indep_build_arch', conf.rebuild_indep_build_arch)
+        conf.rebuild_indep_build_arch = 'amd64'
+
+    def boost(self, unblocked, build_time=conf.priority_default_build_time):
+        hours = max(build_time, 60) / 3600
+        return min(conf.priority_max_boost, conf.priority_boost * math.log1p(unblocked / hours)) / (24 * 60 * 60)
+
+    def test_transitive(self):
+        availpkgs = {
+            ('libfoo', 'amd64'): entry(buildable=True),
+            ('bar', 'amd64'): entry(reasons=missing('libfoo-dev')),
+            # waiting for bar, which is waiting for libfoo
+            ('baz', 'amd64'): entry(reasons=missing('libbar-dev')),
+            ('unrelated', 'amd64'): entry(buildable=True),
+            # same source, other arch: not blocked by libfoo:amd64
+            ('bar', 'i386'): entry(reasons=missing('libquux-dev')),
+        }
+        binary_sources = {'libfoo-dev': 'libfoo', 'libbar-dev': 'bar'}
+        priorities = scheduler.compute_priorities(availpkgs, binary_sources, {'libfoo': 30 * 60})
+        self.assertEqual(priorities.keys(), {('libfoo', 'amd64')})
+        self.assertAlmostEqual(priorities[('libfoo', 'amd64')], self.boost(2, 30 * 60))
+
+    def test_arch_all(self):
+        availpkgs = {
+            ('data', 'all'): entry(buildable=True),
+            ('app', 'amd64'): entry(reasons=missing('data-common')),
+            ('app', 'i386'): entry(reasons=missing('data-common')),
+        }
+        priorities = scheduler.compute_priorities(availpkgs, {'data-common': 'data'}, {})
+        self.assertEqual(priorities, {('data', 'all'): self.boost(2)})
+
+    def test_only_buildable_blockers(self):
+        availpkgs = {
+            ('installed', 'amd64'): entry(installed=True),
+            ('unbuildable', 'amd64'): entry(reasons=missing('libmissing-dev')),
+            ('a', 'amd64'): entry(reasons=missing('libinstalled-dev')),
+            ('b', 'amd64'): entry(reasons=missing('libunbuildable-dev')),
+            # not evaluated by dose yet
+            ('c', 'amd64'): entry(),
+        }
+        binary_sources = {'libinstalled-dev': 'installed', 'libunbuildable-dev': 'unbuildable', 'libmissing-dev': 'c'}
+        self.assertEqual(scheduler.compute_priorities(availpkgs, binary_sources, {}), {})
+
+    def test_max_boost(self):
+        self.addCleanup(setattr, conf, 'priority_max_boost', conf.priority_max_boost)
+        conf.priority_max_boost = 60 * 60
+        availpkgs = {('libfoo', 'amd64'): entry(buildable=True)}
+        for i in range(100):
+            availpkgs[(f'rdep{i}', 'amd64')] = entry(reasons=missing('libfoo-dev'))
+        priorities = scheduler.compute_priorities(availpkgs, {'libfoo-dev': 'libfoo'}, {'libfoo': 0})
+        self.assertEqual(priorities, {('libfoo', 'amd64'): conf.priority_max_boost / (24 * 60 * 60)})
+
+    def test_missing_names(self):
+        reasons = missing('libfoo-dev | libbar-dev:any')
+        self.assertEqual(scheduler.missing_names(reasons), {'libfoo-dev', 'libbar-dev'})
+        self.assertEqual(scheduler.missing_names(repo.ScanEntry('1').reasons), set())
+        entry = repo.ScanEntry('1')
+        entry.set_unbuildable(reasons)
+        self.assertEqual(scheduler.missing_names(entry.reasons_yaml()), {'libfoo-dev', 'libbar-dev'})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,234 @@
+import asyncio, sqlite3, sys, tempfile, unittest, yaml
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import micro_buildd_conf as conf
+import metrics, repo, states
+
+class WriteBatchTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.saved_conf = conf.database_path, conf.database_commit_delay
+        conf.database_path = Path(self.tmpdir.name) / 'microbuildd.sqlite'
+        # long enough for all writes of a test to make it into one batch
+        conf.database_commit_delay = 0.5
+        self.statesdb = states.States()
+        await self.statesdb.__aenter__()
+        self.statements = []
+        await self.statesdb.db.set_trace_callback(self.statements.append)
+
+    async def asyncTearDown(self):
+        await self.statesdb.__aexit__()
+        self.tmpdir.cleanup()
+        conf.database_path, conf.database_commit_delay = self.saved_conf
+
+    def commits(self):
+        return [s for s in self.statements if s == 'COMMIT']
+
+    def insert(self, package, fail=False):
+        async def fn():
+            await self.statesdb.db.execute("""INSERT INTO states (Package, Architecture, State) VALUES (:Package, "amd64", "Installed")
+                """, {'Package': package})
+            # nothing is visible to other connections until the batch commits
+            other = sqlite3.connect(conf.database_path)
+            try:
+                self.assertEqual(other.execute("SELECT count(*) FROM states").fetchone()[0], 0)
+            finally:
+                other.close()
+            if fail:
+                raise RuntimeError('failing write')
+            return package
+        return fn
+
+    async def test_one_commit_per_batch(self):
+        results = await asyncio.gather(*(self.statesdb.write(self.insert(f'pkg{i}')) for i in range(5)))
+        self.assertEqual(results, [f'pkg{i}' for i in range(5)])
+        self.assertEqual(len(self.commits()), 1)
+
+    async def test_failing_write_only_undoes_itself(self):
+        results = await asyncio.gather(self.statesdb.write(self.insert('good1')),
+                                       self.statesdb.write(self.insert('bad', fail=True)),
+                                       self.statesdb.write(self.insert('good2')), return_exceptions=True)
+        self.assertEqual(results[0], 'good1')
+        self.assertIsInstance(results[1], RuntimeError)
+        self.assertEqual(results[2], 'good2')
+        self.assertEqual(len(self.commits()), 1)
+        async with self.statesdb.db.execute("SELECT Package FROM states ORDER BY Package") as cursor:
+            self.assertEqual([row['Package'] async for row in cursor], ['good1', 'good2'])
+
+class LeaseTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.saved_conf = conf.database_path
+        conf.database_path = Path(self.tmpdir.name) / 'microbuildd.sqlite'
+        self.statesdb = states.States()
+        await self.statesdb.__aenter__()
+        await self.statesdb.db.execute("""INSERT INTO states (Package, Architecture, Version, State, Timestamp)
+            VALUES ("hello", "amd64", "1.0-1", "Needs-Build", datetime("now"))""")
+        await self.statesdb.db.commit()
+
+    async def asyncTearDown(self):
+        await self.statesdb.__aexit__()
+        self.tmpdir.cleanup()
+        conf.database_path = self.saved_conf
+
+    async def state(self):
+        async with self.statesdb.db.execute("SELECT State FROM states") as cursor:
+            return (await cursor.fetchone())['State']
+
+    async def test_cancelled_claim_is_released(self):
+        lease = self.statesdb.get_package_to_build(first_time=True, event_to_signal_on_failure=asyncio.Event())
+        # keep the writer busy until the lease is cancelled with its claim
+        # still queued
+        unblock = asyncio.Event()
+        blocker = asyncio.create_task(self.statesdb.write(unblock.wait, urgent=True))
+        await asyncio.sleep(0.1)
+        task = asyncio.create_task(lease.__aenter__())
+        while self.statesdb.write_queue.empty():
+            await asyncio.sleep(0.01)
+        task.cancel()
+        unblock.set()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        await blocker
+        # whatever the lease queued has been written by now
+        await self.statesdb.write(lambda: asyncio.sleep(0), urgent=True)
+        self.assertEqual(await self.state(), 'Needs-Build')
+
+    async def test_lease(self):
+        async with self.statesdb.get_package_to_build(first_time=True, event_to_signal_on_failure=asyncio.Event()) as lease:
+            self.assertEqual((lease.package, lease.architecture), ('hello', 'amd64'))
+            self.assertEqual(await self.state(), 'Building')
+            await lease.set_build_result('Uploaded')
+        self.assertEqual(await self.state(), 'Uploaded')
+
+MISSING = [{'missing': {'pkg': {'package': 'src:broken', 'architecture': 'amd64', 'version': '1', 'unsat-dependency': 'libmissing-dev'}}}]
+
+def entry(version, installed=False, buildable=False, reasons=None):
+    res = repo.ScanEntry(version)
+    res.installed = installed
+    if buildable:
+        res.set_buildable()
+    elif reasons is not None:
+        res.set_unbuildable(reasons)
+    return res
+
+class FakeRepo(object):
+    binary_sources = None
+    availpkgs = None
+
+    def __init__(self, availpkgs):
+        self.binary_sources = {}
+        self.availpkgs = availpkgs
+
+    async def scan(self, previous):
+        return self.availpkgs
+
+class UpdateTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.saved_conf = conf.database_path, conf.retry_base_delay, conf.retry_max_attempts
+        conf.database_path = Path(self.tmpdir.name) / 'microbuildd.sqlite'
+        self.statesdb = states.States()
+        await self.statesdb.__aenter__()
+
+    async def asyncTearDown(self):
+        await self.statesdb.__aexit__()
+        self.tmpdir.cleanup()
+        conf.database_path, conf.retry_base_delay, conf.retry_max_attempts = self.saved_conf
+
+    async def insert(self, package, version, state, reasons='', retry_after=None):
+        await self.statesdb.db.execute("""INSERT INTO states (Package, Architecture, Version, State, BDUninstallableReasons, Timestamp, RetryAfter)
+            VALUES (:Package, "amd64", :Version, :State, :Reasons, datetime("now", "-1 day"), datetime("now", :RetryAfter))
+            """, {'Package': package, 'Version': version, 'State': state, 'Reasons': reasons, 'RetryAfter': retry_after})
+        await self.statesdb.db.commit()
+
+    async def states(self):
+        async with self.statesdb.db.execute("""SELECT Package, Version, State, BDUninstallableReasons FROM states ORDER BY Package""") as cursor:
+            return {row['Package']: (row['Version'], row['State'], row['BDUninstallableReasons']) async for row in cursor}
+
+    async def test_transitions(self):
+        await self.insert('gone', '1', 'Installed')
+        await self.insert('hello', '1.0-1', 'Installed')
+        await self.insert('built', '1', 'Uploaded')
+        await self.insert('waiting', '1', 'BD-Uninstallable', 'old reasons')
+        await self.insert('broken', '1', 'Needs-Build')
+        await self.insert('stillbroken', '1', 'BD-Uninstallable', 'old reasons')
+        await self.insert('failed', '1', 'Attempted')
+        await self.statesdb.update(FakeRepo({
+            ('hello', 'amd64'): entry('1.0-2', buildable=True),
+            ('built', 'amd64'): entry('1', installed=True),
+            ('waiting', 'amd64'): entry('1', buildable=True),
+            ('broken', 'amd64'): entry('1', reasons=MISSING),
+            ('stillbroken', 'amd64'): entry('1', reasons=MISSING),
+            ('failed', 'amd64'): entry('1', buildable=True),
+            ('new', 'amd64'): entry('1', reasons=MISSING),
+        }))
+        reasons = yaml.safe_dump(MISSING)
+        self.assertEqual(await self.states(), {
+            'hello': ('1.0-2', 'Needs-Build', ''),
+            'built': ('1', 'Installed', ''),
+            'waiting': ('1', 'Needs-Build', ''),
+            'broken': ('1', 'BD-Uninstallable', reasons),
+            'stillbroken': ('1', 'BD-Uninstallable', reasons),
+            'failed': ('1', 'Attempted', ''),
+            'new': ('1', 'BD-Uninstallable', reasons),
+        })
+
+    async def test_retry_after(self):
+        await self.insert('due', '1', 'Given-Back', retry_after='-1 minute')
+        await self.insert('later', '1', 'Given-Back', retry_after='+1 hour')
+        await self.insert('unbuildable', '1', 'Given-Back', retry_after='-1 minute')
+        await self.statesdb.update(FakeRepo({
+            ('due', 'amd64'): entry('1', buildable=True),
+            ('later', 'amd64'): entry('1', buildable=True),
+            ('unbuildable', 'amd64'): entry('1', reasons=MISSING),
+        }))
+        self.assertEqual({pkg: state for pkg, (version, state, reasons) in (await self.states()).items()},
+                         {'due': 'Needs-Build', 'later': 'Given-Back', 'unbuildable': 'Given-Back'})
+
+    async def test_retry(self):
+        conf.retry_base_delay = 0
+        conf.retry_max_attempts = 2
+        availpkgs = {('flaky', 'amd64'): entry('1', buildable=True)}
+        await self.insert('flaky', '1', 'Building')
+        await self.statesdb.register_build_result('flaky', 'amd64', '1', None, 'Given-Back', retry=True)
+        await self.statesdb.update(FakeRepo(availpkgs))
+        self.assertEqual((await self.states())['flaky'][1], 'Needs-Build')
+        # the second failure is the last attempt
+        await self.statesdb.db.execute("""UPDATE states SET State = "Building"
+            """)
+        await self.statesdb.db.commit()
+        await self.statesdb.register_build_result('flaky', 'amd64', '1', None, 'Given-Back', retry=True)
+        await self.statesdb.update(FakeRepo(availpkgs))
+        self.assertEqual((await self.states())['flaky'][1], 'Given-Back')
+
+class MetricsTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.saved_conf = conf.database_path
+        conf.database_path = Path(self.tmpdir.name) / 'microbuildd.sqlite'
+        self.statesdb = states.States()
+        await self.statesdb.__aenter__()
+        await self.statesdb.db.execute("""INSERT INTO states (Package, Architecture, State) VALUES ("hello", "amd64", "Installed")""")
+        await self.statesdb.db.commit()
+
+    async def asyncTearDown(self):
+        await self.statesdb.__aexit__()
+        self.tmpdir.cleanup()
+        conf.database_path = self.saved_conf
+
+    async def test_collect_during_update(self):
+        # as update() does, with its changes not committed yet
+        async with self.statesdb.db_lock.exclusive():
+            await self.statesdb.db.execute("""BEGIN IMMEDIATE""")
+            await self.statesdb.db.execute("""UPDATE states SET State = "Needs-Build"
+                """)
+            await asyncio.wait_for(self.statesdb.collect_metrics(), timeout=5)
+            await self.statesdb.db.commit()
+        self.assertEqual(metrics.registry.values[('microbuildd_packages', (('state', 'Installed'),))], 1)
+        self.assertNotIn(('microbuildd_packages', (('state', 'Needs-Build'),)), metrics.registry.values)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import asyncio, json, sys, tempfile, unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import micro_buildd_conf as conf
+import httpd, states, workers
+
+class WorkerServerTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        base = Path(self.tmpdir.name)
+        self.saved_conf = {name: getattr(conf, name) for name in ('database_path', 'worker_listen', 'worker_token', 'worker_upload_dir',
+                                                                   'worker_heartbeat_interval', 'worker_lease_timeout')}
+        conf.database_path = base / 'microbuildd.sqlite'
+        conf.worker_listen = base / 'worker.sock'
+        conf.worker_token = None
+        conf.worker_upload_dir = base / 'uploads'
+        conf.worker_heartbeat_interval = 0.05
+        conf.worker_lease_timeout = 60
+        self.statesdb = states.States()
+        await self.statesdb.__aenter__()
+        await self.statesdb.db.execute("""INSERT INTO states (Package, Architecture, Version, State, Timestamp)
+            VALUES ("hello", "amd64", "1.0-1", "Needs-Build", datetime("now"))""")
+        await self.statesdb.db.commit()
+        self.server = workers.WorkerServer(self.statesdb, None)
+        self.server_task = asyncio.create_task(self.server.run())
+        while not conf.worker_listen.exists():
+            await asyncio.sleep(0.01)
+
+    async def asyncTearDown(self):
+        self.server_task.cancel()
+        await asyncio.wait([self.server_task])
+        await self.statesdb.__aexit__()
+        self.tmpdir.cleanup()
+        for name, value in self.saved_conf.items():
+            setattr(conf, name, value)
+
+    async def request(self, method, target, body=b''):
+        reader, writer = await httpd.open_connection(conf.worker_listen)
+        try:
+            httpd.start_request(writer, method, target, (('Content-Length', len(body)), ('Connection', 'close')))
+            writer.write(body)
+            status, headers = await httpd.read_response(reader)
+            return status, await reader.readexactly(int(headers.get('content-length', 0)))
+        finally:
+            writer.close()
+
+    async def lease(self):
+        status, body = await self.request('POST', '/lease', json.dumps({'worker': 'test', 'architectures': ['amd64']}).encode())
+        self.assertEqual(status, 200)
+        return json.loads(body)['id']
+
+    async def state(self):
+        async with self.statesdb.db.execute("SELECT State FROM states") as cursor:
+            return (await cursor.fetchone())['State']
+
+    async def test_upload_names(self):
+        job_id = await self.lease()
+        for name in ('.hidden', '..', '%2E%2E', 'a%2Fb', '..%2Fescaped'):
+            status, body = await self.request('PUT', f'/jobs/{job_id}/files/{name}', b'contents')
+            self.assertEqual(status, 400, name)
+        self.assertEqual(list(conf.worker_upload_dir.rglob('*')), [conf.worker_upload_dir / job_id])
+        status, body = await self.request('PUT', f'/jobs/{job_id}/files/hello_1.0-1_amd64.build', b'contents')
+        self.assertEqual(status, 200)
+        self.assertEqual((conf.worker_upload_dir / job_id / 'hello_1.0-1_amd64.build').read_bytes(), b'contents')
+
+    async def test_lease_expiry(self):
+        conf.worker_lease_timeout = 0.2
+        job_id = await self.lease()
+        self.assertEqual(await self.state(), 'Building')
+        # heartbeats keep the lease
+        for i in range(5):
+            await asyncio.sleep(0.1)
+            status, body = await self.request('POST', f'/jobs/{job_id}/heartbeat')
+            self.assertEqual(status, 200)
+        # the upload directory goes once the lease has been released
+        while (conf.worker_upload_dir / job_id).exists():
+            await asyncio.sleep(0.05)
+        self.assertNotIn(job_id, self.server.jobs)
+        self.assertEqual(await self.state(), 'Needs-Build')
+        status, body = await self.request('POST', f'/jobs/{job_id}/heartbeat')
+        self.assertEqual(status, 404)
+
+    async def test_unknown_job(self):
+        status, body = await self.request('PUT', '/jobs/0123abcd/files/hello.build', b'contents')
+        self.assertEqual(status, 404)
+
+if __name__ == '__main__':
+    unittest.main()
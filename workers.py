@@ -0,0 +1,208 @@
+import asyncio, json, logging, re, secrets, shutil, time, urllib.parse
+import httpd, metrics, shield_util
+import micro_buildd_conf as conf
+
+CHUNK_SIZE = 1024 * 1024
+
+class Job(object):
+    build_lease = None
+    worker = None
+    uploaddir = None
+    deadline = None
+    started = None
+
+    def __init__(self, build_lease, worker, uploaddir):
+        self.build_lease = build_lease
+        self.worker = worker
+        self.uploaddir = uploaddir
+        self.deadline = None
+        self.started = time.time()
+        self.heard_from()
+
+    def heard_from(self):
+        self.deadline = time.monotonic() + conf.worker_lease_timeout
+
+class WorkerServer(object):
+    """
+    Hands out builds to remote workers (see microbuildd_worker) over HTTP.
+    Requests and responses are JSON unless noted otherwise:
+
+    - POST /lease {"worker": name, "architectures": [...]}: lease the next
+      package to build on one of the architectures, waiting for up to
+      conf.worker_poll_timeout seconds.  Returns the job, or 204 if there
+      is nothing to build.
+    - POST /jobs/<id>/heartbeat: the worker is still building.  404 means
+      the lease has expired and the worker should give up on the build.
+    - PUT /jobs/<id>/files/<name>: upload a file of the build, the body
+      being its contents: the .build log, rusage.json, and for successful
+      builds the .changes file and the files it lists.
+    - POST /jobs/<id>/complete {"timed_out": bool}: the build is done and
+      all its files are uploaded; processed just like a local build.
+
+    A job whose worker isn't heard from for conf.worker_lease_timeout
+    seconds goes back to Needs-Build.
+    """
+
+    statesdb = None
+    chroot = None
+    jobs = None
+    requests = None
+
+    def __init__(self, statesdb, chroot):
+        self.statesdb = statesdb
+        self.chroot = chroot
+        self.jobs = {}
+        # tasks handling requests, cancelled and waited for on shutdown
+        self.requests = set()
+        # nothing can be waiting for uploads from before a restart, their
+        # leases were reclaimed on startup
+        if conf.worker_upload_dir.is_dir():
+            shutil.rmtree(conf.worker_upload_dir)
+        conf.worker_upload_dir.mkdir(parents=True)
+
+    async def run(self):
+        try:
+            await asyncio.gather(httpd.serve(self.handle, conf.worker_listen), self.expire_loop())
+        finally:
+            # completions are shielded, so these are done processing
+            for task in self.requests:
+                task.cancel()
+            if self.requests:
+                await asyncio.wait(self.requests)
+            for job_id in list(self.jobs):
+                await self.release(job_id, 'daemon shutting down')
+
+    async def expire_loop(self):
+        while True:
+            await asyncio.sleep(conf.worker_heartbeat_interval)
+            now = time.monotonic()
+            for job_id, job in list(self.jobs.items()):
+                if job.deadline < now:
+                    await self.release(job_id, f'no heartbeat from {job.worker}')
+
+    async def release(self, job_id, reason):
+        job = self.jobs.pop(job_id)
+        lease = job.build_lease
+        logging.warning(f'Returning {lease.package}:{lease.architecture} to Needs-Build: {reason}')
+        try:
+            await lease.release()
+        finally:
+            await self.finish(job)
+
+    async def finish(self, job):
+        lease = job.build_lease
+        try:
+            await lease.__aexit__(None, None, None)
+        finally:
+            shutil.rmtree(job.uploaddir, ignore_errors=True)
+            metrics.registry.inc('microbuildd_builds_running', -1)
+            metrics.registry.observe('microbuildd_build_seconds', job.started, time.time() - job.started,
+                                     arch=lease.architecture, result=lease.build_result or 'Internal-Error')
+
+    async def handle(self, request, reader, writer):
+        task = asyncio.current_task()
+        self.requests.add(task)
+        try:
+            await self.dispatch(request, reader, writer)
+        finally:
+            self.requests.discard(task)
+
+    async def dispatch(self, request, reader, writer):
+        if conf.worker_token is not None and request.headers.get('authorization') != f'Bearer {conf.worker_token}':
+            httpd.send_response(writer, 401, 'Unauthorized\n')
+            return
+        path = request.target.split('?')[0]
+        if request.method == 'POST' and path == '/lease':
+            await self.handle_lease(request, reader, writer)
+        elif m := re.fullmatch('/jobs/([0-9a-f]+)/(heartbeat|complete|files/([^/]+))', path):
+            job = self.jobs.get(m[1])
+            if job is None:
+                # expired, or from before a restart
+                await httpd.read_body(reader, request)
+                httpd.send_response(writer, 404, 'No such job\n')
+            elif request.method == 'POST' and m[2] == 'heartbeat':
+                await httpd.read_body(reader, request)
+                job.heard_from()
+                httpd.send_response(writer, 200, '{}', 'application/json')
+            elif request.method == 'PUT' and m[3] is not None:
+                await self.handle_upload(job, urllib.parse.unquote(m[3]), request, reader, writer)
+            elif request.method == 'POST' and m[2] == 'complete':
+                await self.handle_complete(m[1], request, reader, writer)
+            else:
+                await httpd.read_body(reader, request)
+                httpd.send_response(writer, 405, 'Method not allowed\n')
+        else:
+            await httpd.read_body(reader, request)
+            httpd.send_response(writer, 404, 'Not found\n')
+
+    async def handle_lease(self, request, reader, writer):
+        try:
+            params = json.loads(await httpd.read_body(reader, request))
+            worker = str(params['worker'])
+            architectures = [str(arch) for arch in params['architectures']]
+        except (ValueError, KeyError, TypeError):
+            httpd.send_response(writer, 400, 'Expected {"worker": ..., "architectures": [...]}\n')
+            return
+        if conf.rebuild_indep_build_arch in architectures:
+            architectures.append('all')
+
+        # the lease is only left through finish(), once the job is done
+        lease = self.statesdb.get_package_to_build(first_time=True, event_to_signal_on_failure=asyncio.Event(),
+                                                   architectures=architectures, timeout=conf.worker_poll_timeout)
+        await lease.__aenter__()
+        if lease.package is None:
+            httpd.send_response(writer, 204)
+            return
+
+        job_id = secrets.token_hex(16)
+        uploaddir = conf.worker_upload_dir / job_id
+        uploaddir.mkdir()
+        job = self.jobs[job_id] = Job(lease, worker, uploaddir)
+        metrics.registry.inc('microbuildd_builds_running')
+        logging.info(f'Worker {worker} leased {lease.package}:{lease.architecture}')
+        httpd.send_response(writer, 200, json.dumps({
+            'id': job_id,
+            'package': lease.package,
+            'architecture': lease.architecture,
+            'version': lease.version,
+            'binnmu_version': lease.binnmu_version,
+            'binnmu_changelog': lease.binnmu_changelog,
+            'heartbeat_interval': conf.worker_heartbeat_interval,
+        }), 'application/json')
+
+    async def handle_upload(self, job, name, request, reader, writer):
+        if name.startswith('.') or '/' in name:
+            await httpd.read_body(reader, request)
+            httpd.send_response(writer, 400, 'Invalid file name\n')
+            return
+        remaining = int(request.headers.get('content-length', 0))
+        with open(job.uploaddir / name, 'wb') as fh:
+            while remaining:
+                chunk = await reader.readexactly(min(remaining, CHUNK_SIZE))
+                fh.write(chunk)
+                remaining -= len(chunk)
+                job.heard_from()
+        httpd.send_response(writer, 200, '{}', 'application/json')
+
+    async def handle_complete(self, job_id, request, reader, writer):
+        try:
+            timed_out = bool(json.loads(await httpd.read_body(reader, request)).get('timed_out'))
+        except (ValueError, AttributeError):
+            httpd.send_response(writer, 400, 'Expected {"timed_out": ...}\n')
+            return
+        job = self.jobs.pop(job_id, None)
+        if job is None:
+            # expired while the request was being read
+            httpd.send_response(writer, 404, 'No such job\n')
+            return
+        await shield_util.shield_and_wait(self.complete(job, timed_out))
+        httpd.send_response(writer, 200, json.dumps({'result': job.build_lease.build_result}), 'application/json')
+
+    async def complete(self, job, timed_out):
+        lease = job.build_lease
+        try:
+            await self.chroot.finish_build(lease, self.statesdb, job.uploaddir, timed_out, {'Worker': job.worker})
+        except Exception as e:
+            logging.error(f'Processing the build of {lease.package}:{lease.architecture} by {job.worker} failed: {e}')
+        finally:
+            await self.finish(job)